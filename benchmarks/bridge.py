@@ -0,0 +1,173 @@
+"""
+End to end benchmark of the bridge against the simulated mesh and MQTT broker in simulator.py, so no lights are needed.
+
+    python benchmarks/bridge.py [--nodes N] [--rounds N] [--connections N] [--write-rate N] [--latency S] [--jitter S]
+                                [--loss P] [--notifications N] [--min-rate COMMANDS_PER_SEC]
+
+Each round publishes a brightness command to every light, which goes through the same path as in production:
+mqtt_consume, the command scheduler, mesh_send, the mesh writer and the connected nodes. The simulated lights echo their
+new state back through the notification pipeline, and state is only published once that echo arrives
+(commands.confirm_state). Reported are commands/sec, the latency from publishing a command until its state is published
+back, and the rate at which a flood of notifications is reassembled, decrypted and decoded.
+
+Writes are paced at --write-rate like the real mesh; raise it to measure the bridge itself rather than the pacing.
+"""
+
+import asyncio
+import json
+import sys
+import time
+from argparse import ArgumentParser
+from typing import Callable, Dict, List, Tuple
+
+import avionmqtt.mesh
+from avionmqtt import Site, mqtt_consume, site_pipeline
+from avionmqtt.discovery import MQTT_TOPIC_PREFIX, DiscoveryPublisher
+from avionmqtt.mesh import MESH_WRITE_RATE, MESH_WRITE_WINDOW
+from avionmqtt.metrics import NOTIFICATIONS_DECODED
+from avionmqtt.protocol import Noun
+from avionmqtt.state import StateStore
+from simulator import MqttStandIn, SimulatedScanner, VirtualMesh
+
+SETTINGS = {"devices": {"import": True}, "groups": {"import": True}}
+
+
+def percentile(values: List[float], p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+async def wait_for(predicate: Callable[[], bool], timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        await asyncio.sleep(0.001)
+    return True
+
+
+async def bench(args) -> int:
+    mesh = VirtualMesh(
+        args.nodes,
+        latency=args.latency,
+        jitter=args.jitter,
+        loss=args.loss,
+        write_latency=args.write_latency,
+        seed=args.seed,
+    )
+    # the pool connects through the simulated nodes instead of bleak
+    avionmqtt.mesh.BleakClient = mesh.client
+    mqtt = MqttStandIn()
+    settings = dict(
+        SETTINGS,
+        mesh={"connections": args.connections, "write_rate": args.write_rate, "write_window": args.write_window},
+        commands={"confirm_state": True},
+    )
+    site = Site(mesh.location, MQTT_TOPIC_PREFIX, StateStore(mqtt, 0), settings)
+    # every light counts as just seen, so polling stays out of the way
+    site.last_seen.update({avid: time.monotonic() for avid in mesh.avids})
+
+    # state topic -> (brightness we're waiting for, when the command was published)
+    pending: Dict[str, Tuple[int, float]] = {}
+    latencies: List[float] = []
+
+    def published(topic: str, payload: str):
+        expected = pending.get(topic)
+        if expected and json.loads(payload).get("brightness") == expected[0]:
+            latencies.append(time.monotonic() - expected[1])
+            del pending[topic]
+
+    mqtt.on_publish = published
+    await mqtt.subscribe(site.command_topic)
+    tasks = [
+        asyncio.create_task(site_pipeline(mqtt, SimulatedScanner(mesh), site, settings)),
+        asyncio.create_task(mqtt_consume(mqtt, DiscoveryPublisher(mqtt), [site])),
+    ]
+    try:
+        connected = await wait_for(
+            lambda: len(mesh.clients) >= args.connections and site.commands is not None, args.timeout
+        )
+        if not connected:
+            print("unable to connect to the simulated mesh")
+            return 1
+
+        commands = 0
+        unconfirmed = 0
+        elapsed = 0.0
+        for i in range(args.rounds):
+            # a different value every round, as unchanged states aren't published again
+            brightness = 1 + i % 254
+            started = time.monotonic()
+            for avid in mesh.avids:
+                pending[f"{site.prefix}/{avid}/state"] = (brightness, time.monotonic())
+                mqtt.inject(f"{site.prefix}/{avid}/command", json.dumps({"brightness": brightness}))
+                commands += 1
+            await wait_for(lambda: not pending, args.timeout)
+            elapsed += time.monotonic() - started
+            unconfirmed += len(pending)
+            pending.clear()
+
+        rate = commands / elapsed
+        print(
+            f"commands: {commands} in {elapsed:.3f}s: {rate:,.0f}/sec "
+            f"({mesh.written} packets written, {site.commands.collapsed} group collapses, {unconfirmed} unconfirmed)"
+        )
+        if latencies:
+            print(
+                "command to state: "
+                + ", ".join(f"p{p} {percentile(latencies, p) * 1000:.1f}ms" for p in (50, 90, 99))
+                + f", max {max(latencies) * 1000:.1f}ms"
+            )
+
+        # encrypt up front, so only the bridge's side of the notifications is timed
+        reports = []
+        for i in range(args.notifications):
+            avid = mesh.avids[i % len(mesh.avids)]
+            mesh.states[avid]["brightness"] = i % 256
+            reports.append(mesh.report(avid, Noun.DIMMING.value))
+        decoded = NOTIFICATIONS_DECODED.get()
+        started = time.monotonic()
+        for i, (low, high) in enumerate(reports):
+            mesh.notify(low, high)
+            if i % 64 == 63:
+                # the BLE callbacks arrive from the event loop too, in bursts
+                await asyncio.sleep(0)
+        await wait_for(lambda: NOTIFICATIONS_DECODED.get() - decoded >= len(reports), args.timeout)
+        notification_elapsed = time.monotonic() - started
+        count = NOTIFICATIONS_DECODED.get() - decoded
+        print(
+            f"notifications: decoded {count:.0f} of {len(reports)} in {notification_elapsed:.3f}s: "
+            f"{count / notification_elapsed:,.0f}/sec"
+        )
+
+        if rate < args.min_rate:
+            print(f"below the minimum of {args.min_rate:,.0f} commands/sec")
+            return 1
+        return 0
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--nodes", type=int, default=32, help="simulated lights")
+    parser.add_argument("--rounds", type=int, default=10, help="commands sent to every light")
+    parser.add_argument("--connections", type=int, default=1, help="mesh nodes the bridge connects to")
+    parser.add_argument("--write-rate", type=float, default=MESH_WRITE_RATE, help="packets per second")
+    parser.add_argument("--write-window", type=int, default=MESH_WRITE_WINDOW, help="packets in flight")
+    parser.add_argument("--write-latency", type=float, default=0.0, help="seconds every GATT write takes")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds for a packet to reach a light")
+    parser.add_argument("--jitter", type=float, default=0.01, help="up to this many seconds added to the latency")
+    parser.add_argument("--loss", type=float, default=0.0, help="probability a light misses a packet")
+    parser.add_argument("--notifications", type=int, default=5000, help="notifications in the decode flood")
+    parser.add_argument("--timeout", type=float, default=10, help="seconds to wait for a round to complete")
+    parser.add_argument("--seed", type=int, default=None, help="seed for latency and loss")
+    parser.add_argument("--min-rate", type=float, default=0, help="fail when slower than this (commands per second)")
+    args = parser.parse_args()
+    return asyncio.run(bench(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
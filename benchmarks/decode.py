@@ -0,0 +1,70 @@
+"""
+Micro-benchmark for decoding decrypted mesh notifications.
+
+    python benchmarks/decode.py [--iterations N] [--min-rate DECODES_PER_SEC]
+
+The corpus holds decrypted payloads in the shapes seen on the mesh: state echoes addressed by source, writes addressed
+to a device or group, read replies, and payloads the bridge ignores. Every entry is checked against its expected record
+before timing, so both correctness and speed regressions show up. With --min-rate the script exits non-zero when the
+measured rate falls below the given threshold.
+"""
+
+import sys
+import time
+from argparse import ArgumentParser
+
+from avionmqtt.protocol import mesh_decode
+
+# (source, decrypted payload, expected record)
+CORPUS = [
+    # dimming echo from a device, addressed by source
+    (32897, "008073000a000000ff000000", (32897, "brightness", 255)),
+    (32897, "008073000a000000c8000000", (32897, "brightness", 200)),
+    # brightness write to a device
+    (0, "818073000a0000008000000000", (32897, "brightness", 128)),
+    # brightness write to a group
+    (0, "000073000a000500ff00000000", (5, "brightness", 255)),
+    # color temperature write to a device and to the whole mesh
+    (0, "818073001d0000000113880000", (32897, "color_temp", 5000)),
+    (0, "000073001d0000000109c40000", (0, "color_temp", 2500)),
+    # read replies
+    (32898, "008073010a0040000000", (32898, "brightness", 64)),
+    (32898, "008073011d0000177000", (32898, "color_temp", 6000)),
+    # things we don't track: unknown nouns, unknown verbs, empty payloads and foreign packets
+    (32897, "008073011900000000", None),
+    (32897, "0080730900000000", None),
+    (32897, "0080730000000000", None),
+    (32897, "008072000a000000", None),
+]
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=20000, help="passes over the corpus")
+    parser.add_argument("--min-rate", type=float, default=0, help="fail when decoding slower than this (per second)")
+    args = parser.parse_args()
+
+    corpus = [(source, bytes.fromhex(payload), expected) for source, payload, expected in CORPUS]
+    for source, payload, expected in corpus:
+        record = mesh_decode(source, payload)
+        if record != expected:
+            print(f"decode mismatch for {payload.hex()} from {source}: {record} != {expected}")
+            return 1
+
+    started = time.perf_counter()
+    for _ in range(args.iterations):
+        for source, payload, _ in corpus:
+            mesh_decode(source, payload)
+    elapsed = time.perf_counter() - started
+
+    decodes = args.iterations * len(corpus)
+    rate = decodes / elapsed
+    print(f"decoded {decodes} payloads in {elapsed:.3f}s: {rate:,.0f}/sec, {elapsed / decodes * 1e9:.0f}ns each")
+    if rate < args.min_rate:
+        print(f"below the minimum of {args.min_rate:,.0f}/sec")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
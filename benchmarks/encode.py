@@ -0,0 +1,130 @@
+"""
+Micro-benchmark for encoding and encrypting outgoing commands.
+
+    python benchmarks/encode.py [--devices N] [--iterations N] [--min-rate COMMANDS_PER_SEC]
+
+Compares the templated batch path (packet_encode and mesh_encode_batch) with the per-command path it replaced, which is
+kept below as the baseline: every packet built from scratch by create_packet, then encrypted on its own with a fresh
+random sequence number. The two must produce the same packets, and every encrypted batch must decrypt back to them,
+before anything is timed. Both encoding alone and encoding plus encryption are reported.
+"""
+
+import sys
+import time
+from argparse import ArgumentParser
+from typing import List, Tuple
+
+import csrmesh
+
+from avionmqtt import location_avids, mesh_key
+from avionmqtt.mesh import mesh_encode_batch
+from avionmqtt.protocol import MESH_FIRST_DEVICE_AVID, Noun, Verb, packet_encode, packet_templates_prepare
+
+KEY = mesh_key("benchmark")
+
+
+# the per-command path before templates
+def create_packet(target_id: int, verb: Verb, noun: Noun, value_bytes: bytearray) -> bytes:
+    if target_id < MESH_FIRST_DEVICE_AVID:
+        group_id = target_id
+        target_id = 0
+    else:
+        group_id = 0
+
+    target_bytes = bytearray(target_id.to_bytes(2, byteorder="big"))
+    group_bytes = bytearray(group_id.to_bytes(2, byteorder="big"))
+    return bytes(
+        [
+            target_bytes[1],
+            target_bytes[0],
+            0x73,
+            verb.value,
+            noun.value,
+            group_bytes[0],
+            group_bytes[1],
+            0,  # id
+            *value_bytes,
+            0,
+            0,
+        ]
+    )
+
+
+def baseline_encode(avid: int, noun: Noun, value: int) -> bytes:
+    if noun == Noun.COLOR:
+        color = bytes([0x01, *bytearray(value.to_bytes(2, byteorder="big"))])
+        return create_packet(avid, Verb.WRITE, Noun.COLOR, color)
+    return create_packet(avid, Verb.WRITE, Noun.DIMMING, bytes([value, 0, 0]))
+
+
+def baseline_encrypt(packet: bytes) -> Tuple[bytes, bytes]:
+    csrpacket = csrmesh.crypto.make_packet(KEY, csrmesh.crypto.random_seq(), packet)
+    return csrpacket[:20], csrpacket[20:]
+
+
+def timed(label: str, count: int, iterations: int, run) -> float:
+    started = time.perf_counter()
+    for _ in range(iterations):
+        run()
+    elapsed = time.perf_counter() - started
+    rate = count * iterations / elapsed
+    print(f"{label}: {count * iterations} commands in {elapsed:.3f}s: {rate:,.0f}/sec")
+    return rate
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--devices", type=int, default=64, help="lights in the simulated inventory")
+    parser.add_argument("--iterations", type=int, default=200, help="passes over every command")
+    parser.add_argument("--min-rate", type=float, default=0, help="fail when encrypting slower than this (per second)")
+    args = parser.parse_args()
+
+    avids = [MESH_FIRST_DEVICE_AVID + 1 + i for i in range(args.devices)]
+    groups = list(range(1, args.devices // 4 + 1))
+    location = {"devices": [{"avid": avid} for avid in avids], "groups": [{"avid": group} for group in groups]}
+    packet_templates_prepare(location_avids(location))
+
+    # a brightness and a color temperature command for every light, group and the whole mesh
+    commands: List[Tuple[int, Noun, int]] = []
+    for i, avid in enumerate([0, *groups, *avids]):
+        commands.append((avid, Noun.DIMMING, i % 256))
+        commands.append((avid, Noun.COLOR, 2700 + i % 3800))
+
+    for avid, noun, value in commands:
+        if packet_encode(avid, noun, value) != baseline_encode(avid, noun, value):
+            print(f"encode mismatch for {noun.name}={value} to {avid}")
+            return 1
+    for (avid, noun, value), (low, high) in zip(commands, mesh_encode_batch(commands, KEY)):
+        decoded = csrmesh.crypto.decrypt_packet(KEY, low + high)
+        if decoded.get("hmac_computed") != decoded.get("hmac_packet"):
+            print(f"encrypted {noun.name}={value} to {avid} doesn't authenticate")
+            return 1
+        if bytes(decoded["decpayload"]) != packet_encode(avid, noun, value):
+            print(f"encrypted {noun.name}={value} to {avid} doesn't decrypt to its packet")
+            return 1
+
+    count = len(commands)
+    baseline = timed(
+        "encode, baseline", count, args.iterations, lambda: [baseline_encode(*command) for command in commands]
+    )
+    templated = timed(
+        "encode, templated", count, args.iterations, lambda: [packet_encode(*command) for command in commands]
+    )
+    print(f"encode speedup: {templated / baseline:.1f}x")
+    baseline = timed(
+        "encode and encrypt, baseline",
+        count,
+        args.iterations,
+        lambda: [baseline_encrypt(baseline_encode(*command)) for command in commands],
+    )
+    batched = timed("encode and encrypt, batched", count, args.iterations, lambda: mesh_encode_batch(commands, KEY))
+    print(f"encode and encrypt speedup: {batched / baseline:.1f}x")
+
+    if batched < args.min_rate:
+        print(f"below the minimum of {args.min_rate:,.0f}/sec")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
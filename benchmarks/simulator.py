@@ -0,0 +1,260 @@
+"""
+An offline stand-in for an Avi-on mesh and an MQTT broker, so the bridge can be exercised without any lights.
+
+VirtualMesh models a set of nodes that share a passphrase. Packets written to a SimulatedClient are decrypted with the
+real csrmesh crypto, applied to the nodes they address (a device, a group or the whole mesh) and echoed back as
+encrypted notifications through every connected client, just like the mesh relays them. DIMMING and COLOR writes
+change a node's state, reads only make it report. Delivery to every node can be delayed (`latency` plus up to `jitter`
+seconds) and lost (with probability `loss`), and every GATT write can take `write_latency` seconds.
+
+MqttStandIn implements the parts of aiomqtt.Client the bridge uses: publish, subscribe and the messages iterator.
+"""
+
+import asyncio
+import random
+from types import SimpleNamespace
+from typing import Callable, Dict, List, Optional, Tuple
+
+import csrmesh
+
+from avionmqtt import mesh_key
+from avionmqtt.mesh import CHARACTERISTIC_HIGH, CHARACTERISTIC_LOW
+from avionmqtt.protocol import Noun, Verb
+
+FIRST_AVID = 32897
+PRODUCT_ID = 134  # Smart Bulb (A19), dimmable with color temperature
+PROPERTIES = ["read", "write", "write-without-response", "notify"]
+
+
+class VirtualMesh:
+    def __init__(
+        self,
+        nodes: int = 16,
+        group_size: int = 4,
+        passphrase: str = "simulated",
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        loss: float = 0.0,
+        write_latency: float = 0.0,
+        seed: Optional[int] = None,
+    ):
+        self.key = mesh_key(passphrase)
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.write_latency = write_latency
+        self._random = random.Random(seed)
+        self._seq = self._random.randrange(1 << 24)
+        self.avids = [FIRST_AVID + i for i in range(nodes)]
+        self.states = {avid: {"brightness": 0, "color_temp": 2700} for avid in self.avids}
+        self.groups: Dict[int, List[int]] = {}
+        for i in range(0, nodes, group_size):
+            self.groups[1 + i // group_size] = self.avids[i : i + group_size]
+        self.location = {
+            "pid": "simulated",
+            "name": "Simulated",
+            "passphrase": passphrase,
+            "devices": [
+                {
+                    "pid": f"device-{avid}",
+                    "product_id": PRODUCT_ID,
+                    "avid": avid,
+                    "name": f"Light {avid}",
+                    "mac_address": self.mac(avid),
+                }
+                for avid in self.avids
+            ],
+            "groups": [
+                {
+                    "pid": f"group-{group}",
+                    "product_id": 0,
+                    "avid": group,
+                    "name": f"Group {group}",
+                    "devices": [f"device-{avid}" for avid in members],
+                }
+                for group, members in self.groups.items()
+            ],
+        }
+        self.clients: List["SimulatedClient"] = []
+        self.written = 0
+        self.notified = 0
+
+    @staticmethod
+    def mac(avid: int) -> str:
+        return "00:00:00:00:" + ":".join(format(b, "02x") for b in avid.to_bytes(2, byteorder="big"))
+
+    def devices(self) -> List[SimpleNamespace]:
+        """Stand-ins for the BLEDevices a scan would find, all with the same signal strength."""
+        return [SimpleNamespace(address=self.mac(avid), name=f"Light {avid}") for avid in self.avids]
+
+    def client(self, device, disconnected_callback: Callable = None, **kwargs) -> "SimulatedClient":
+        """Use in place of BleakClient."""
+        return SimulatedClient(self, device, disconnected_callback)
+
+    def _targets(self, packet: bytes) -> List[int]:
+        # see packet_header for the layout
+        target = packet[1] << 8 | packet[0]
+        if target:
+            return [target] if target in self.states else []
+        group = packet[5] << 8 | packet[6]
+        return list(self.avids) if group == 0 else self.groups.get(group, [])
+
+    def receive(self, packet: bytes):
+        """Handles a packet written to the mesh through one of the clients."""
+        decoded = csrmesh.crypto.decrypt_packet(self.key, packet)
+        if decoded.get("hmac_computed") != decoded.get("hmac_packet"):
+            return
+        payload = decoded["decpayload"]
+        self.written += 1
+        verb, noun = payload[3], payload[4]
+        if noun not in (Noun.DIMMING.value, Noun.COLOR.value) or verb not in (Verb.WRITE.value, Verb.READ.value):
+            return
+        loop = asyncio.get_running_loop()
+        for avid in self._targets(payload):
+            if self._random.random() < self.loss:
+                continue
+            delay = self.latency + self._random.random() * self.jitter
+            loop.call_later(delay, self._deliver, avid, verb, noun, payload)
+
+    def _deliver(self, avid: int, verb: int, noun: int, payload: bytes):
+        state = self.states[avid]
+        if verb == Verb.WRITE.value:
+            if noun == Noun.DIMMING.value:
+                state["brightness"] = payload[8]
+            else:
+                state["color_temp"] = payload[9] << 8 | payload[10]
+        self.notify(*self.report(avid, noun))
+
+    def report(self, avid: int, noun: int) -> Tuple[bytes, bytes]:
+        """Encrypts the state report of a node, split into the LOW and HIGH halves it is notified in."""
+        state = self.states[avid]
+        # laid out like the read replies in benchmarks/decode.py
+        if noun == Noun.DIMMING.value:
+            value = bytes([0, state["brightness"], 0, 0])
+        else:
+            value = bytes([0, 0, *state["color_temp"].to_bytes(2, byteorder="big")])
+        payload = bytes([avid & 0xFF, avid >> 8, 0x73, Verb.READ.value, noun, *value])
+        # nodes count their sequence numbers up, random ones would now and then repeat within the dedup window
+        self._seq = (self._seq + 1) & 0xFFFFFF
+        packet = csrmesh.crypto.make_packet(self.key, self._seq, payload)
+        return packet[:20], packet[20:]
+
+    def notify(self, low: bytes, high: bytes):
+        """Relays a report through every connected client, as the mesh floods it to every node."""
+        self.notified += 1
+        for client in list(self.clients):
+            client.notify(low, high)
+
+
+class SimulatedClient:
+    def __init__(self, mesh: VirtualMesh, device, disconnected_callback: Callable = None):
+        self._mesh = mesh
+        self.address = device.address
+        self._disconnected_callback = disconnected_callback
+        self._callbacks: Dict[str, Callable] = {}
+        self._low: Optional[bytes] = None
+        self.is_connected = False
+        characteristic = SimpleNamespace(properties=PROPERTIES)
+        self.services = SimpleNamespace(get_characteristic=lambda uuid: characteristic)
+
+    async def connect(self):
+        self.is_connected = True
+        self._mesh.clients.append(self)
+
+    async def disconnect(self):
+        if self.is_connected:
+            self.is_connected = False
+            self._mesh.clients.remove(self)
+
+    def drop(self):
+        """Simulates the node going out of range."""
+        if self.is_connected:
+            self.is_connected = False
+            self._mesh.clients.remove(self)
+            if self._disconnected_callback:
+                self._disconnected_callback(self)
+
+    async def start_notify(self, uuid: str, callback: Callable):
+        self._callbacks[uuid] = callback
+
+    async def write_gatt_char(self, uuid: str, data: bytes, response: bool = False):
+        if not self.is_connected:
+            raise ConnectionError(f"{self.address} is not connected")
+        if self._mesh.write_latency:
+            await asyncio.sleep(self._mesh.write_latency)
+        if uuid == CHARACTERISTIC_LOW:
+            self._low = bytes(data)
+        elif uuid == CHARACTERISTIC_HIGH and self._low is not None:
+            packet, self._low = self._low + bytes(data), None
+            self._mesh.receive(packet)
+
+    def notify(self, low: bytes, high: bytes):
+        if CHARACTERISTIC_LOW in self._callbacks:
+            self._callbacks[CHARACTERISTIC_LOW](CHARACTERISTIC_LOW, bytearray(low))
+        if high and CHARACTERISTIC_HIGH in self._callbacks:
+            self._callbacks[CHARACTERISTIC_HIGH](CHARACTERISTIC_HIGH, bytearray(high))
+
+
+class SimulatedScanner:
+    """Takes the place of MeshScanner, every node of the mesh is always in range."""
+
+    def __init__(self, mesh: VirtualMesh):
+        self._mesh = mesh
+
+    def watch(self, event: asyncio.Event):
+        pass
+
+    def unwatch(self, event: asyncio.Event):
+        pass
+
+    def candidates(self, targets) -> list:
+        return [device for device in self._mesh.devices() if device.address.lower() in targets]
+
+
+class Topic:
+    def __init__(self, value: str):
+        self.value = value
+
+    def matches(self, pattern: str) -> bool:
+        levels = self.value.split("/")
+        patterns = pattern.split("/")
+        for i, part in enumerate(patterns):
+            if part == "#":
+                return True
+            if i >= len(levels) or (part != "+" and part != levels[i]):
+                return False
+        return len(levels) == len(patterns)
+
+
+class MqttStandIn:
+    def __init__(self):
+        self._incoming: asyncio.Queue = asyncio.Queue()
+        self.subscriptions: List[str] = []
+        self.retained: Dict[str, str] = {}
+        self.published = 0
+        # called with (topic, payload) for every publish
+        self.on_publish: Optional[Callable[[str, str], None]] = None
+
+    async def publish(self, topic: str, payload: str = "", retain: bool = False, **kwargs):
+        self.published += 1
+        if retain:
+            self.retained[topic] = payload
+        if self.on_publish:
+            self.on_publish(topic, payload)
+
+    async def subscribe(self, topic: str, **kwargs):
+        self.subscriptions.append(topic)
+
+    def inject(self, topic: str, payload: str):
+        """Delivers a message to the bridge, as if another client published it."""
+        self._incoming.put_nowait(SimpleNamespace(topic=Topic(topic), payload=payload.encode()))
+
+    @property
+    def messages(self):
+        return self._messages()
+
+    async def _messages(self):
+        while True:
+            message = await self._incoming.get()
+            if any(message.topic.matches(subscription) for subscription in self.subscriptions):
+                yield message
@@ -4,6 +4,10 @@ import aiohttp
 
 HTTP_HOST = "https://api.avi-on.com"
 HTTP_TIMEOUT = 5
+HTTP_CONCURRENCY = 8
+HTTP_RETRIES = 3
+HTTP_RETRY_BACKOFF = 0.5
+HTTP_RETRY_STATUSES = {429, 500, 502, 503, 504}
 
 
 def util_format_mac_address(mac_address: str) -> str:
@@ -12,13 +16,29 @@ def util_format_mac_address(mac_address: str) -> str:
     return ":".join(a + b for a, b in pairs)
 
 
+def http_create_session() -> aiohttp.ClientSession:
+    # the connector limit bounds how many requests are in flight when loading concurrently
+    return aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=HTTP_CONCURRENCY))
+
+
+def http_timeout(timeout: float) -> aiohttp.ClientTimeout:
+    # a request queued behind the connector limit hasn't been sent yet, so waiting for a free connection doesn't count
+    # against its timeout: only connecting and waiting for the server do
+    return aiohttp.ClientTimeout(sock_connect=timeout, sock_read=timeout)
+
+
 async def http_make_request(
     host: str,
     path: str,
     body: dict = None,
     auth_token: str = None,
     timeout: int = HTTP_TIMEOUT,
+    session: aiohttp.ClientSession = None,
 ):
+    if session is None:
+        async with http_create_session() as session:
+            return await http_make_request(host, path, body, auth_token, timeout, session)
+
     method = "GET" if body is None else "POST"
     url = host + path
 
@@ -27,14 +47,23 @@ async def http_make_request(
         headers["Accept"] = "application/api.avi-on.v3"
         headers["Authorization"] = f"Token {auth_token}"
 
-    async with aiohttp.ClientSession() as session:
-        async with session.request(method, url, json=body, headers=headers, timeout=timeout) as response:
-            return await response.json()
-
-
-async def http_load_devices(host: str, auth_token: str, location_id: str, timeout: int) -> List[dict]:
+    request_timeout = http_timeout(timeout)
+    for attempt in range(HTTP_RETRIES + 1):
+        try:
+            async with session.request(method, url, json=body, headers=headers, timeout=request_timeout) as response:
+                if response.status not in HTTP_RETRY_STATUSES or attempt == HTTP_RETRIES:
+                    return await response.json()
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            if attempt == HTTP_RETRIES:
+                raise
+        await asyncio.sleep(HTTP_RETRY_BACKOFF * 2**attempt)
+
+
+async def http_load_devices(
+    host: str, auth_token: str, location_id: str, timeout: int, session: aiohttp.ClientSession = None
+) -> List[dict]:
     response = await http_make_request(
-        host, f"locations/{location_id}/abstract_devices", auth_token=auth_token, timeout=timeout
+        host, f"locations/{location_id}/abstract_devices", auth_token=auth_token, timeout=timeout, session=session
     )
     raw_devices = response["abstract_devices"]
     devices = []
@@ -54,50 +83,66 @@ async def http_load_devices(host: str, auth_token: str, location_id: str, timeou
     return devices
 
 
-async def http_get_devices_in_group(host: str, auth_token: str, group_id: int, timeout: int):
-    response = await http_make_request(host, f"groups/{group_id}", auth_token=auth_token, timeout=timeout)
+async def http_get_devices_in_group(
+    host: str, auth_token: str, group_id: int, timeout: int, session: aiohttp.ClientSession = None
+):
+    response = await http_make_request(
+        host, f"groups/{group_id}", auth_token=auth_token, timeout=timeout, session=session
+    )
     raw_response = response["group"]
     return raw_response["devices"]
 
 
-async def http_load_groups(host: str, auth_token: str, location_id: str, timeout: int) -> List[dict]:
-    response = await http_make_request(host, f"locations/{location_id}/groups", auth_token=auth_token, timeout=timeout)
+async def http_load_groups(
+    host: str, auth_token: str, location_id: str, timeout: int, session: aiohttp.ClientSession = None
+) -> List[dict]:
+    response = await http_make_request(
+        host, f"locations/{location_id}/groups", auth_token=auth_token, timeout=timeout, session=session
+    )
     raw_groups = response["groups"]
+    members = await asyncio.gather(
+        *(http_get_devices_in_group(host, auth_token, raw_group["pid"], timeout, session) for raw_group in raw_groups)
+    )
     groups = []
 
-    for raw_group in raw_groups:
+    for raw_group, devices in zip(raw_groups, members):
         pid = raw_group["pid"]
         avid = raw_group["avid"]
         name = raw_group["name"]
-        devices = await http_get_devices_in_group(host, auth_token, pid, timeout)
         group = {"pid": pid, "product_id": 0, "avid": avid, "name": name, "devices": devices}
         groups.append(group)
 
     return groups
 
 
-async def http_load_location(host: str, auth_token: str, location_id: int, timeout: int) -> dict:
-    response = await http_make_request(host, f"locations/{location_id}", auth_token=auth_token, timeout=timeout)
-    raw_location = response["location"]
-    devices, groups = await asyncio.gather(
-        http_load_devices(host, auth_token, location_id, timeout),
-        http_load_groups(host, auth_token, location_id, timeout),
+async def http_load_location(
+    host: str, auth_token: str, location_id: int, timeout: int, session: aiohttp.ClientSession = None
+) -> dict:
+    response, devices, groups = await asyncio.gather(
+        http_make_request(host, f"locations/{location_id}", auth_token=auth_token, timeout=timeout, session=session),
+        http_load_devices(host, auth_token, location_id, timeout, session),
+        http_load_groups(host, auth_token, location_id, timeout, session),
     )
+    raw_location = response["location"]
     return {
+        "pid": location_id,
+        "name": raw_location.get("name"),
         "passphrase": raw_location["passphrase"],
         "devices": devices,
         "groups": groups,
     }
 
 
-async def http_load_locations(host: str, auth_token: str, timeout: int) -> List[dict]:
-    response = await http_make_request(host, "user/locations", auth_token=auth_token, timeout=timeout)
-    locations = []
-    for raw_location in response["locations"]:
-        location = await http_load_location(host, auth_token, raw_location["pid"], timeout)
-        locations.append(location)
+async def http_load_locations(
+    host: str, auth_token: str, timeout: int, session: aiohttp.ClientSession = None
+) -> List[dict]:
+    response = await http_make_request(host, "user/locations", auth_token=auth_token, timeout=timeout, session=session)
+    raw_locations = response["locations"]
+    locations = await asyncio.gather(
+        *(http_load_location(host, auth_token, raw_location["pid"], timeout, session) for raw_location in raw_locations)
+    )
 
-    return locations
+    return list(locations)
 
 
 async def http_list_devices(
@@ -109,10 +154,12 @@ async def http_list_devices(
     if not host.endswith("/"):
         host += "/"
 
-    login_body = {"email": email, "password": password}
-    response = await http_make_request(host, "sessions", login_body, timeout=timeout)
-    if "credentials" not in response:
-        raise Exception("Invalid credentials for HALO Home")
-    auth_token = response["credentials"]["auth_token"]
+    # one pooled session for the whole inventory load, so connections (and TLS) are reused
+    async with http_create_session() as session:
+        login_body = {"email": email, "password": password}
+        response = await http_make_request(host, "sessions", login_body, timeout=timeout, session=session)
+        if "credentials" not in response:
+            raise Exception("Invalid credentials for HALO Home")
+        auth_token = response["credentials"]["auth_token"]
 
-    return await http_load_locations(host, auth_token, timeout)
+        return await http_load_locations(host, auth_token, timeout, session)
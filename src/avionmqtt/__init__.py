@@ -1,33 +1,73 @@
+from .startup import STARTUP
 from argparse import ArgumentParser
 import asyncio
-from typing import List
+import importlib
+import time
+from typing import Awaitable, Callable, Dict, FrozenSet, List, Optional, Set, Tuple
 import yaml
 import json
 import aiomqtt
 import logging
 import csrmesh
-from bleak import BleakClient, BleakScanner, BleakGATTCharacteristic
-from bleak.exc import BleakError
 from binascii import unhexlify, hexlify
-from enum import Enum
 import signal
 import sys
 from aiorun import run
-from avionhttp import http_list_devices
-from .webserver import start_webserver, LOG_BUFFER, LOG_LOCK, device_list
-import threading
+from .discovery import (
+    CAPABILITIES,
+    MQTT_AVAILABILITY_TOPIC,
+    MQTT_TOPIC_PREFIX,
+    DiscoveryPublisher,
+    discovery_messages,
+)
+from .commands import (
+    DEFAULT_GROUP_WINDOW,
+    DEFAULT_QUEUE_DEPTH,
+    OVERFLOW_DROP_OLDEST,
+    PRIORITY_SWITCH,
+    CommandScheduler,
+    command_brightness,
+    command_validate,
+)
+from .inventory import INVENTORY_RETRY_INTERVAL, INVENTORY_TTL, inventory_default_path, inventory_load, inventory_save
+from .protocol import (
+    MESH_FIRST_DEVICE_AVID,
+    MESH_PACKET_MIN_SIZE,
+    Noun,
+    Verb,
+    mesh_decode,
+    packet_encode,
+    packet_templates_prepare,
+)
+from .mesh import CHARACTERISTIC_HIGH, CHARACTERISTIC_LOW, MESH_CONNECTIONS, MeshPool, MeshScanner, MeshWriter
+from .metrics import MQTT_COMMANDS, SCENE_SECONDS
+from .notifications import DEFAULT_NOTIFICATION_DEPTH, NotificationPipeline
+from .polling import DEFAULT_POLL_INTERVAL, DEFAULT_POLL_RATE, PollScheduler
+from .scenes import SCENE_REPORT_TOPIC, scene_parse, scene_plan, scene_switch_on
+from .snapshot import (
+    SNAPSHOT_INTERVAL,
+    snapshot_default_path,
+    snapshot_dumps,
+    snapshot_load,
+    snapshot_monotonic,
+    snapshot_save,
+    snapshot_time,
+)
+from .state import DEFAULT_MIN_INTERVAL, StateStore
+from .tracking import DEFAULT_CONFIRM_DEADLINE, DEFAULT_CONFIRM_RETRIES, CommandTracker
+from .transitions import FADE_SHARE, FADE_TIME_MAX, FadeScheduler
+from .logbuffer import LOG_BUFFER
+
 
 def add_log_entry(text):
-    with LOG_LOCK:
-        LOG_BUFFER.append(text)
-        if len(LOG_BUFFER) > 500:
-            LOG_BUFFER.pop(0)
-
-async def handle_ble_notification(sender, data):
-    import datetime
-    timestamp = datetime.datetime.now().strftime("%H:%M:%S")
+    LOG_BUFFER.append(text)
+
+
+def handle_ble_notification(sender, data):
+    timestamp = time.strftime("%H:%M:%S")
     add_log_entry(f"[{timestamp}] BLE from {sender}: {data.hex()}")
 
+
 def publish_discovery(mqtt_client, device):
     """Publish Home Assistant MQTT Discovery for an Avi-on light."""
     mac_id = device.mac_address.replace(":", "_")
@@ -50,91 +90,17 @@ def publish_discovery(mqtt_client, device):
         "unique_id": f"avionmqtt_{mac_id}",
     }
 
-    mqtt_client.publish(
-        discovery_topic,
-        json.dumps(payload),
-        retain=True
-    )
+    mqtt_client.publish(discovery_topic, json.dumps(payload), retain=True)
+
 
 MQTT_RETRY_INTERVAL = 5
-CHARACTERISTIC_LOW = "c4edc000-9daf-11e3-8003-00025b000b00"
-CHARACTERISTIC_HIGH = "c4edc000-9daf-11e3-8004-00025b000b00"
-
-CAPABILITIES = {"dimming": {0, 90, 93, 94, 97, 134, 137, 162}, "color_temp": {0, 93, 134, 137, 162}}
-PRODUCT_NAMES = {
-    0: "Group",
-    90: "Lamp Dimmer",
-    93: "Recessed Downlight (RL)",
-    94: "Light Adapter",
-    97: "Smart Dimmer",
-    134: "Smart Bulb (A19)",
-    137: "Surface Downlight (BLD)",
-    162: "MicroEdge (HLB)",
-    167: "Smart Switch",
-}
-
-
-class Verb(Enum):
-    WRITE = 0
-    READ = 1
-    INSERT = 2
-    TRUNCATE = 3
-    COUNT = 4
-    DELETE = 5
-    PING = 6
-    SYNC = 7
-    OTA = 8
-    PUSH = 11
-    SCAN_WIFI = 12
-    CANCEL_DATASTREAM = 13
-    UPDATE = 16
-    TRIM = 17
-    DISCONNECT_OTA = 18
-    UNREGISTER = 20
-    MARK = 21
-    REBOOT = 22
-    RESTART = 23
-    OPEN_SSH = 32
-    NONE = 255
-
-
-class Noun(Enum):
-    DIMMING = 10
-    FADE_TIME = 25
-    COUNTDOWN = 9
-    DATE = 21
-    TIME = 22
-    SCHEDULE = 7
-    GROUPS = 3
-    SUNRISE_SUNSET = 6
-    ASSOCIATION = 27
-    WAKE_STATUS = 28
-    COLOR = 29
-    CONFIG = 30
-    WIFI_NETWORKS = 31
-    DIMMING_TABLE = 17
-    ASSOCIATED_WIFI_NETWORK = 32
-    ASSOCIATED_WIFI_NETWORK_STATUS = 33
-    SCENES = 34
-    SCHEDULE_2 = 35
-    RAB_IP = 36
-    RAB_ENV = 37
-    RAB_CONFIG = 38
-    THERMOMETER = 39
-    FIRMWARE_VERSION = 40
-    LUX_VALUE = 41
-    TEST_MODE = 42
-    HARCODED_STRING = 43
-    RAB_MARKS = 44
-    MOTION_SENSOR = 45
-    ALS_DIMMING = 46
-    ASSOCIATION_2 = 48
-    RTC_SUN_RISE_SET_TABLE = 71
-    RTC_DATE = 72
-    RTC_TIME = 73
-    RTC_DAYLIGHT_SAVING_TIME_TABLE = 74
-    AVION_SENSOR = 91
-    NONE = 255
+SHUTDOWN_TIMEOUT = 5
+SHUTDOWN_DRAIN = 2
+
+# listed by the web UI at /devices
+device_list = []
+# the event loop only keeps weak references to tasks, so the ones nothing waits on are kept here
+background_tasks: Set[asyncio.Task] = set()
 
 
 logger = logging.getLogger(__name__)
@@ -148,286 +114,550 @@ def settings_get(file: str):
             logger.exception(exc)
 
 
-async def mqtt_register(use_single_device: bool, mqtt: aiomqtt.Client, entity: dict):
-    import re  # <-- Move import inside or keep at top of file
-
-    product_id = entity["product_id"]
-    pid = entity["pid"]
-    avid = entity["avid"]
-    name = entity["name"]
-
-    # https://www.home-assistant.io/integrations/light.mqtt/
-    config = {
-        "component": "light",
-        "object_id": f"avid_{avid}",
-        "unique_id": pid,
-        "schema": "json",
-        "payload_off": "OFF",
-        "payload_on": "ON",
-        "brightness": product_id in CAPABILITIES["dimming"],
-        "color_mode": product_id in CAPABILITIES["color_temp"],
-        "effect": False,
-        "availability_mode": "latest",
-        "availability_topic": f"hmd/light/avid/{avid}/availability",
-        "state_topic": f"hmd/light/avid/{avid}/state",
-        "json_attributes_topic": f"hmd/light/avid/{avid}/attributes",
-        "command_topic": f"hmd/light/avid/{avid}/command",
+class Site:
+    """
+    One Avi-on location: its inventory, the MQTT topics its lights live under, their discovery messages and their
+    states. While MQTT is connected it also runs its own mesh pipeline (see `site_run`), whose command and poll
+    schedulers are kept here.
+    """
+
+    def __init__(self, location: dict, prefix: str, states: StateStore, settings: dict):
+        self.location = location
+        self.prefix = prefix
+        self.command_topic = f"{prefix}/+/command"
+        self.states = states
+        # rendered once (and again when the inventory changes), rather than whenever Home Assistant comes online
+        self.discovery = discovery_messages(settings, location, prefix)
+        # derived once per location, rather than whenever the mesh (re)connects
+        self.key = mesh_key(location["passphrase"])
+        packet_templates_prepare(location_avids(location))
+        # when each device last reported its state, kept across mesh pipeline restarts
+        self.last_seen: Dict[int, float] = {}
+        # the fade time (ms) each light that fades by itself was last given, lights keep it until told otherwise
+        self.fade_times: Dict[int, int] = {}
+        self.commands: Optional[CommandScheduler] = None
+        self.poller: Optional[PollScheduler] = None
+        self.writer: Optional[MeshWriter] = None
+        # commands/sec the mesh took when first measured, kept across mesh pipeline restarts so it is measured once
+        self.throughput: Optional[float] = None
+        # applies a scene (name, lights, when it was received) through the mesh pipeline
+        self.scene: Optional[Callable[[str, Dict[int, dict], float], Awaitable]] = None
+        # set on shutdown, polling stops so queued commands can drain
+        self.stopping = False
+        # set when the inventory of the location changed, the mesh pipeline then restarts to pick it up
+        self.reload = asyncio.Event()
+
+    @property
+    def name(self) -> str:
+        return self.location.get("name") or self.prefix
+
+    def drained(self) -> bool:
+        """Whether every command taken in was written to the mesh, or there is no mesh to write it to."""
+        if self.commands is None or not self.writer:
+            return True
+        return len(self.commands) == 0 and self.writer.pending == 0
+
+    def snapshot(self) -> Dict[int, list]:
+        snapshot = {}
+        for avid, state in self.states.items():
+            seen = self.last_seen.get(avid)
+            snapshot[avid] = [
+                state.get("brightness"),
+                state.get("color_temp"),
+                None if seen is None else round(snapshot_time(seen), 1),
+            ]
+        return snapshot
+
+    def restore(self, snapshot: Dict[int, list]):
+        for avid, (brightness, color_temp, seen) in snapshot.items():
+            self.states.seed(avid, {"brightness": brightness, "color_temp": color_temp})
+            if seen is not None:
+                self.last_seen[avid] = snapshot_monotonic(seen)
+
+
+def location_topic_prefix(location: dict, index: int, count: int) -> str:
+    # a lone location keeps the topics the bridge has always used, avids are only unique within a location
+    if count == 1:
+        return MQTT_TOPIC_PREFIX
+    return f"hmd/light/{location.get('pid', index)}/avid"
+
+
+def location_group_members(location: dict) -> Dict[int, FrozenSet[int]]:
+    # groups list their members by pid, while the mesh addresses them by avid
+    avids = {device["pid"]: device["avid"] for device in location["devices"]}
+    return {
+        group["avid"]: frozenset(avids[pid] for pid in group["devices"] if pid in avids) for group in location["groups"]
     }
 
-    if use_single_device:
-        config["name"] = name
-        config["device"] = {"identifiers": ["avionmqtt"], "name": "Avi-on MQTT Bridge"}
-    else:
-        config["device"] = {
-            "identifiers": [pid],
-            "name": name,
-            "manufacturer": "Avi-on",
-            "model": PRODUCT_NAMES.get(product_id, f"Unknown product ({product_id})"),
-            "serial_number": pid,
-        }
 
-    # Fix object_id based on light name
-    friendly_name = name or f"Avi-on Light {avid}"
-    object_id = re.sub(r'[^a-z0-9_]', '', friendly_name.lower().replace(" ", "_"))
+def location_avids(location: dict) -> List[int]:
+    # 0 addresses the whole mesh
+    return [0, *(group["avid"] for group in location["groups"]), *(device["avid"] for device in location["devices"])]
 
-    config["object_id"] = object_id
-    config["name"] = friendly_name
 
-    if product_id in CAPABILITIES["color_temp"]:
-        config["supported_color_modes"] = ["color_temp"]
+def mesh_get_color_temp_packet(target_id: int, color: int) -> bytes:
+    return packet_encode(target_id, Noun.COLOR, color)
 
-    await mqtt.publish(
-        f"homeassistant/light/{object_id}/config",
-        json.dumps(config),
-        retain=True,
-    )
 
-    await mqtt.publish(
-        f"hmd/light/avid/{avid}/availability",
-        "online",
-        retain=True,
-    )
+def mesh_get_brightness_packet(target_id: int, brightness: int) -> bytes:
+    return packet_encode(target_id, Noun.DIMMING, brightness)
 
 
-async def mqtt_register_category(use_single_device: bool, settings: dict, list: List[dict], mqtt: aiomqtt.Client):
-    if settings["import"]:
-        include = settings.get("include", None)
-        exclude = settings.get("exclude", {})
-        for entity in list:
-            pid = entity["pid"]
-            if (include is not None and pid in include) or pid not in exclude:
-                await mqtt_register(use_single_device, mqtt, entity)
-
-
-async def mqtt_register_lights(settings: dict, location: dict, mqtt: aiomqtt.Client):
-    logger.info("mqtt: Registering devices")
-    use_single_device = settings.get("single_device", False)
-    await mqtt_register_category(use_single_device, settings["groups"], location["groups"], mqtt)
-
-    if settings["devices"].get("exclude_in_group"):
-        exclude = settings["devices"].get("exclude", set())
-        for group in location["groups"]:
-            devices = group["devices"]
-            exclude |= set(devices)
-        settings["devices"]["exclude"] = exclude
-    await mqtt_register_category(use_single_device, settings["devices"], location["devices"], mqtt)
-    if "all" in settings:
-        await mqtt_register(
-            use_single_device, mqtt, {"pid": "avion_all", "product_id": 0, "avid": 0, "name": settings["all"]["name"]}
-        )
+def mesh_get_packets(avid: int, payload: dict, fade: Optional[int] = None) -> List[bytes]:
+    packets = []
+    if fade is not None:
+        # ahead of the values it applies to
+        packets.append(packet_encode(avid, Noun.FADE_TIME, fade))
+    brightness = command_brightness(payload)
+    if brightness is not None:
+        packets.append(mesh_get_brightness_packet(avid, brightness))
+    if "color_temp" in payload:
+        mired = payload["color_temp"]
+        kelvin = (int)(1000000 / mired)
+        logger.info(f"mesh: Converting mired({mired}) to kelvin({kelvin})")
+        packets.append(mesh_get_color_temp_packet(avid, kelvin))
+    return packets
 
 
-def create_packet(target_id: int, verb: Verb, noun: Noun, value_bytes: bytearray) -> bytes:
-    if target_id < 32896:
-        group_id = target_id
-        target_id = 0
-    else:
-        group_id = 0
-
-    target_bytes = bytearray(target_id.to_bytes(2, byteorder="big"))
-    group_bytes = bytearray(group_id.to_bytes(2, byteorder="big"))
-    return bytes(
-        [
-            target_bytes[1],
-            target_bytes[0],
-            0x73,
-            verb.value,
-            noun.value,
-            group_bytes[0],
-            group_bytes[1],
-            0,  # id
-            *value_bytes,
-            0,
-            0,
-        ]
-    )
+async def mesh_sent(
+    avid: int, packet: bytes, states: StateStore, tracker: CommandTracker, members: Tuple[int, ...] = ()
+):
+    """Records what a packet written to `avid` changes: expected back from the lights, or published right away."""
+    record = mesh_decode(avid, packet)
+    if not record:
+        return
+    target, field, value = record
+    # lights echo state under their own avid, so only devices (or the known members of a group) can confirm
+    confirmers = members or ((target,) if target >= MESH_FIRST_DEVICE_AVID else ())
+    if confirmers:
+        tracker.expect(confirmers, field, value, packet)
+    if tracker.optimistic or not confirmers:
+        logger.info("mesh: Acknowedging directly")
+        await states.update(target, field, value)
+        # a group packet stands in for its members, so they all get the new state too
+        for member in members:
+            await states.update(member, field, value)
+
+
+async def mesh_send(
+    avid: int,
+    payload: dict,
+    states: StateStore,
+    writer: MeshWriter,
+    tracker: CommandTracker,
+    members: Tuple[int, ...] = (),
+    fade: Optional[int] = None,
+) -> bool:
+    packets = mesh_get_packets(avid, payload, fade)
+    if not packets:
+        logger.warning("mesh: Unknown payload")
+        return False
 
+    # encrypted together, brightness and color temperature usually travel as a pair
+    await writer.write_many(packets)
+    for packet in packets:
+        await mesh_sent(avid, packet, states, tracker, members)
+    return True
 
-async def mesh_write_gatt(mesh: BleakClient, packet: bytes, key: str) -> bool:
-    logger.debug("-".join(map(lambda b: format(b, "02x"), packet)))
 
-    csrpacket = csrmesh.crypto.make_packet(key, csrmesh.crypto.random_seq(), packet)
-    low = csrpacket[:20]
-    high = csrpacket[20:]
-    await mesh.write_gatt_char(CHARACTERISTIC_LOW, low)
-    await mesh.write_gatt_char(CHARACTERISTIC_HIGH, high)
+async def mesh_command(
+    avid: int,
+    payload: dict,
+    members: Tuple[int, ...],
+    site: Site,
+    writer: MeshWriter,
+    tracker: CommandTracker,
+    fades: FadeScheduler,
+    groups: Dict[int, FrozenSet[int]],
+    native: Set[int],
+) -> bool:
+    """
+    Sends a command, fading to it over its `transition` (seconds) if it has one: lights that can (`native`) are given
+    the fade time and do it by themselves, the others are faded in steps.
+    """
+    if avid == 0:
+        targets = tuple(device["avid"] for device in site.location["devices"]) or (avid,)
+    else:
+        targets = members or tuple(groups.get(avid, ())) or (avid,)
+    # a newer command stops every fade it overlaps, be that of a group it is for, or of one of the lights in it
+    lights = frozenset((avid, *targets))
+    fades.cancel(lights)
+    transition = payload.get("transition") or 0
+    if all(target in native for target in targets):
+        fade = min(round(transition * 1000), FADE_TIME_MAX)
+        changed = any(site.fade_times.get(target) != fade for target in targets)
+        await mesh_send(avid, payload, site.states, writer, tracker, members, fade if changed else None)
+        for target in targets:
+            site.fade_times[target] = fade
+        return True
+
+    brightness = command_brightness(payload)
+    state = site.states.get(avid) or site.states.get(targets[0]) or {}
+    start = state.get("brightness")
+    if not transition or brightness is None or start is None or start == brightness:
+        return await mesh_send(avid, payload, site.states, writer, tracker, members)
+    if "color_temp" in payload:
+        # the color changes right away, so the light fades in the color it ends up in
+        await mesh_send(avid, {"color_temp": payload["color_temp"]}, site.states, writer, tracker, members)
+    fades.start(avid, members, lights, start, {"brightness": brightness}, transition)
     return True
 
 
-def mesh_get_color_temp_packet(target_id: int, color: int) -> bytearray:
-    return create_packet(
-        target_id,
-        Verb.WRITE,
-        Noun.COLOR,
-        bytes([0x01, *bytearray(color.to_bytes(2, byteorder="big"))]),
+async def mesh_scene(
+    mqtt: aiomqtt.Client,
+    name: str,
+    lights: Dict[int, dict],
+    received: float,
+    site: Site,
+    writer: MeshWriter,
+    tracker: CommandTracker,
+    commands: CommandScheduler,
+    fades: FadeScheduler,
+    groups: Dict[int, FrozenSet[int]],
+):
+    """Applies a scene as a whole (see `scene_plan`), and reports how long it took from being `received`."""
+    # the scene overrides whatever was still on its way to its lights
+    for avid in lights:
+        commands.cancel(avid)
+    fades.cancel(lights.keys())
+    known = {avid: state["brightness"] for avid, state in site.states.items() if state.get("brightness")}
+    scene_switch_on(lights, known)
+    # the whole mesh is the largest group of all
+    devices = frozenset(device["avid"] for device in site.location["devices"])
+    plan = scene_plan(lights, {0: devices, **groups}, set(known))
+    packets = [mesh_get_packets(target, {field: value})[0] for target, field, value, _ in plan]
+    await writer.write_many(packets)
+    for (target, _, _, members), packet in zip(plan, packets):
+        await mesh_sent(target, packet, site.states, tracker, members)
+    await writer.flush()
+
+    elapsed = time.monotonic() - received
+    SCENE_SECONDS.observe(elapsed)
+    grouped = sum(1 for _, _, _, members in plan if members)
+    logger.info(
+        f"scene: {name} applied to {len(lights)} lights of {site.name} with {len(packets)} packets "
+        f"({grouped} to groups) in {elapsed:.3f} seconds"
     )
+    report = {
+        "scene": name,
+        "location": site.name,
+        "lights": len(lights),
+        "packets": len(packets),
+        "group_packets": grouped,
+        "seconds": round(elapsed, 3),
+    }
+    await mqtt.publish(SCENE_REPORT_TOPIC, json.dumps(report))
 
 
-def mesh_get_brightness_packet(target_id: int, brightness: int) -> bytearray:
-    return create_packet(target_id, Verb.WRITE, Noun.DIMMING, bytes([brightness, 0, 0]))
-
-
-async def mesh_send(avid: int, raw_payload: str, mqtt: aiomqtt.Client, mesh: BleakClient, key: str) -> bool:
-    payload = json.loads(raw_payload)
-    if "brightness" in payload:
-        packet = mesh_get_brightness_packet(avid, payload["brightness"])
-    elif "color_temp" in payload:
-        mired = payload["color_temp"]
-        kelvin = (int)(1000000 / mired)
-        logger.info(f"mesh: Converting mired({mired}) to kelvin({kelvin})")
-        packet = mesh_get_color_temp_packet(avid, kelvin)
-    elif "state" in payload:
-        packet = mesh_get_brightness_packet(avid, 255 if payload["state"] == "ON" else 0)
-    else:
-        logger.warning("mesh: Unknown payload")
-        return False
-
-    if await mesh_write_gatt(mesh, packet, key):
-        logger.info("mesh: Acknowedging directly")
-
-        parsed = mesh_parse_command(avid, packet)
-        if parsed:
-            await mqtt_send_state(mqtt, parsed)
+def scene_submit(raw_payload: str, sites: List[Site]):
+    received = time.monotonic()
+    try:
+        name, location, lights = scene_parse(raw_payload)
+    except ValueError as e:
+        logger.warning(f"mqtt: Unable to parse scene {raw_payload}: {e}")
+        return
+    # the location comes as a string, like pids do in discovery scopes
+    matches = [site for site in sites if location is None or location in (str(site.location.get("pid")), site.name)]
+    if len(matches) != 1:
+        # avids are only unique within a location
+        logger.warning(f"mqtt: Scene {name} needs one of the locations {[site.name for site in sites]}")
+        return
+    site = matches[0]
+    if site.commands is None or site.scene is None:
+        logger.warning(f"mesh: {site.name} is restarting, dropping scene {name}")
+        return
+    logger.info(f"mqtt: received scene {name} for {len(lights)} lights of {site.name}")
+    # a newer scene replaces one that hasn't started yet
+    site.commands.submit("scene", PRIORITY_SWITCH, lambda: site.scene(name, lights, received))
+
+
+def command_tracker_create(writer: MeshWriter, settings: dict) -> CommandTracker:
+    return CommandTracker(
+        writer.write,
+        deadline=settings.get("confirm_deadline", DEFAULT_CONFIRM_DEADLINE),
+        retries=settings.get("confirm_retries", DEFAULT_CONFIRM_RETRIES),
+        # by default state is published as soon as a command is written, rather than when the light confirms it
+        optimistic=not settings.get("confirm_state", False),
+    )
 
 
-async def mqtt_subscribe(mqtt: aiomqtt.Client, mesh: BleakClient, key: str, settings: dict, location: dict):
-    await mqtt.subscribe("homeassistant/status")
-    await mqtt.subscribe("hmd/light/avid/+/command")
-    await mqtt.subscribe("avionmqtt")
+async def mqtt_consume(mqtt: aiomqtt.Client, discovery: DiscoveryPublisher, sites: List[Site]):
+    # nothing in here may await the mesh, everything that touches it goes through the scheduler of the site
     async for message in mqtt.messages:
         if message.topic.matches("homeassistant/status"):
             if message.payload.decode() == "online":
                 logger.info("mqtt: Home Assistant back online")
-                await mqtt_register_lights(settings, location, mqtt)
+                for site in sites:
+                    discovery.publish(site.discovery)
             else:
                 logger.info("mqtt: Home Assistant offline")
-        elif message.topic.matches("hmd/light/avid/+/command"):
-            json = message.payload.decode()
-            avid = int(message.topic.value.split("/")[3])
-            logger.info(f"mqtt: received {json} for {avid}")
-            await mesh_send(avid, json, mqtt, mesh, key)
         elif message.topic.matches("avionmqtt"):
-            if message.payload.decode() == "poll_mesh":
+            raw_payload = message.payload.decode()
+            if raw_payload == "poll_mesh":
                 logger.info("mqtt: polling mesh")
-                await mesh_read_all(mesh, key)
-
-
-async def mqtt_send_state(mqtt: aiomqtt.Client, message: dict):
-    # TODO: Only send update if we've actually registered this device
-    logger.info(f"mqtt: sending update for {message}")
-    avid = message["avid"]
-    state_topic = f"hmd/light/avid/{avid}/state"
-    if "brightness" in message:
-        brightness = message["brightness"]
-        payload = {
-            "state": "ON" if brightness != 0 else "OFF",
-            "brightness": brightness,
-        }
-    elif "color_temp" in message:
-        color_temp = message["color_temp"]
-        payload = {"color_temp": color_temp}
-    else:
-        return
-
-    await mqtt.publish(state_topic, json.dumps(payload), retain=True)
+                for site in sites:
+                    if site.poller:
+                        site.poller.poll_all()
+            elif raw_payload.startswith("{"):
+                scene_submit(raw_payload, sites)
+        else:
+            site = next((site for site in sites if message.topic.matches(site.command_topic)), None)
+            if site is None:
+                continue
+            raw_payload = message.payload.decode()
+            avid = int(message.topic.value.split("/")[-2])
+            logger.info(f"mqtt: received {raw_payload} for {avid}")
+            MQTT_COMMANDS.inc(avid)
+            try:
+                payload = command_validate(json.loads(raw_payload))
+            except ValueError as e:
+                logger.warning(f"mqtt: Unable to parse {raw_payload} for {avid}: {e}")
+                continue
+            if site.commands is None:
+                logger.warning(f"mesh: {site.name} is restarting, dropping command for {avid}")
+                continue
+            site.commands.submit_command(avid, payload)
+
+
+async def mesh_read(writer: MeshWriter, avid: int):
+    packet = packet_encode(avid, Noun.DIMMING, 0, Verb.READ)
+    await writer.write(packet)
+
+
+def mesh_decrypt(key: str, packet: bytes) -> Optional[dict]:
+    # csrmesh returns None for a packet too short to hold its own framing
+    if len(packet) < MESH_PACKET_MIN_SIZE:
+        return None
+    decoded = csrmesh.crypto.decrypt_packet(key, packet)
+    if decoded is None or decoded.get("hmac_computed") != decoded.get("hmac_packet"):
+        return None
+    return decoded
+
+
+def mesh_key(passphrase: str) -> str:
+    return csrmesh.crypto.generate_key(passphrase.encode("ascii") + b"\x00\x4d\x43\x50")
+
+
+def mesh_notifications(
+    states: StateStore, key: str, tracker: CommandTracker, poller: PollScheduler, settings: dict
+) -> NotificationPipeline:
+    async def publish(avid: int, field: str, value: int):
+        tracker.confirm(avid, field, value)
+        poller.heard(avid)
+        await states.update(avid, field, value)
+
+    return NotificationPipeline(
+        lambda packet: mesh_decrypt(key, packet),
+        publish,
+        depth=settings.get("notification_depth", DEFAULT_NOTIFICATION_DEPTH),
+        # Log raw BLE
+        on_raw=lambda link, is_low, data: handle_ble_notification(
+            f"{link} {CHARACTERISTIC_LOW if is_low else CHARACTERISTIC_HIGH}", data
+        ),
+    )
 
 
-async def mac_ordered_by_rssi():
-    scanned_devices = await BleakScanner.discover(return_adv=True)
-    sorted_devices = sorted(scanned_devices.items(), key=lambda d: d[1][1].rssi)
-    sorted_devices.reverse()
-    return [d[0].lower() for d in sorted_devices]
+async def site_pipeline(mqtt: aiomqtt.Client, scanner: MeshScanner, site: Site, settings: dict):
+    mesh_settings = settings.get("mesh", {})
+    # whatever the inventory looks like now is picked up below
+    site.reload.clear()
+    # every connection, write and notification uses the key of the site
+    key = site.key
+    pool = None
+    writer = MeshWriter(key, mesh_settings, on_lost=lambda mac: pool.lost(mac), throughput=site.throughput)
+    tracker = command_tracker_create(writer, settings.get("commands", {}))
+
+    # commands are coalesced per avid so that a burst (e.g. a slider being dragged) only hits the mesh once per light,
+    # and are dispatched from a dedicated task so a slow BLE write never holds up the MQTT intake
+    command_settings = settings.get("commands", {})
+    groups = location_group_members(site.location)
+    native = {device["avid"] for device in site.location["devices"] if device["product_id"] in CAPABILITIES["fade"]}
+    commands = CommandScheduler(
+        lambda avid, payload, members: mesh_command(
+            avid, payload, members, site, writer, tracker, fades, groups, native
+        ),
+        depth=command_settings.get("queue_depth", DEFAULT_QUEUE_DEPTH),
+        overflow=command_settings.get("overflow", OVERFLOW_DROP_OLDEST),
+        groups=groups if command_settings.get("group_collapse", True) else None,
+        group_window=command_settings.get("group_window", DEFAULT_GROUP_WINDOW),
+    )
+    fades = FadeScheduler(
+        commands,
+        lambda avid, brightness: writer.write(mesh_get_brightness_packet(avid, brightness)),
+        lambda avid, payload, members: mesh_send(avid, payload, site.states, writer, tracker, members),
+        writer.rate,
+        share=command_settings.get("fade_share", FADE_SHARE),
+    )
+    poll_settings = settings.get("polling", {})
+    poller = PollScheduler(
+        lambda avid: mesh_read(writer, avid),
+        lambda: [device["avid"] for device in site.location["devices"]],
+        lambda: len(commands) > 0 or len(fades) > 0 or site.stopping,
+        site.last_seen,
+        interval=poll_settings.get("interval", DEFAULT_POLL_INTERVAL),
+        rate=poll_settings.get("rate", DEFAULT_POLL_RATE),
+    )
+    notifications = mesh_notifications(site.states, key, tracker, poller, mesh_settings)
+
+    async def connected():
+        # devices restored from the snapshot (or seen before a reconnect) are only polled once their state gets stale
+        logger.info(f"mesh: polling unknown devices of {site.name}")
+        poller.poll_unseen()
+        STARTUP.mark("mesh")
+
+    pool = MeshPool(
+        scanner,
+        writer,
+        notifications,
+        lambda: [d["mac_address"].lower() for d in site.location["devices"]],
+        size=mesh_settings.get("connections", MESH_CONNECTIONS),
+        on_connected=connected,
+    )
+    site.commands = commands
+    site.poller = poller
+    site.writer = writer
+    site.scene = lambda name, lights, received: mesh_scene(
+        mqtt, name, lights, received, site, writer, tracker, commands, fades, groups
+    )
+    tasks = {
+        asyncio.create_task(pool.run()),
+        asyncio.create_task(notifications.run()),
+        asyncio.create_task(tracker.run()),
+        asyncio.create_task(commands.run()),
+        asyncio.create_task(poller.run()),
+        asyncio.create_task(site.reload.wait()),
+    }
+    try:
+        # losing mesh nodes doesn't end up here, the pool fails over to the remaining ones and reconnects in the
+        # background; a failed publish does, and so does a changed inventory
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            task.result()
+        if site.reload.is_set():
+            logger.info(f"mesh: Restarting {site.name} with its new devices")
+    finally:
+        site.commands = None
+        site.poller = None
+        site.writer = None
+        site.throughput = writer.throughput
+        site.scene = None
+        fades.close()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        reassembler = notifications.reassembler
+        logger.info(
+            f"mesh: {site.name}: {reassembler.packets} packets, {reassembler.duplicates} duplicates, "
+            f"{reassembler.orphaned} orphaned fragments, {reassembler.dropped} dropped, "
+            f"{notifications.overflowed} overflowed, {notifications.conflated} conflated"
+        )
 
 
-def mesh_parse_data(target_id: int, data: bytearray) -> dict:
-    logger.info(f"mesh: parsing data {data} from {target_id}")
+async def site_run(mqtt: aiomqtt.Client, scanner: MeshScanner, site: Site, settings: dict):
+    """Runs the mesh pipeline of one site, restarting it when it fails, so one location can't take down the others."""
+    while True:
+        try:
+            await site_pipeline(mqtt, scanner, site, settings)
+        except aiomqtt.MqttError:
+            raise
+        except Exception:
+            logger.exception(f"mesh: {site.name} failed; Restarting in {MQTT_RETRY_INTERVAL} seconds ...")
+            await asyncio.sleep(MQTT_RETRY_INTERVAL)
 
-    if data[0] == 0 and data[1] == 0:
-        logger.warning(f"empty data")
-        return
 
-    try:
-        verb = Verb(data[0])
-        noun = Noun(data[1])
+async def bridge_run(
+    mqtt: aiomqtt.Client, scanner: MeshScanner, discovery: DiscoveryPublisher, sites: List[Site], settings: dict
+):
+    """Bridges the meshes of all sites and MQTT for as long as the MQTT connection lasts."""
+    await mqtt.publish(MQTT_AVAILABILITY_TOPIC, "online", retain=True)
+    # register the lights; a new connection might be to a broker that lost its retained messages, so send everything
+    discovery.reset()
+    for site in sites:
+        discovery.publish(site.discovery)
+    # and their last known states, so Home Assistant is right before the mesh even answers
+    for site in sites:
+        await site.states.republish()
 
-        if verb == Verb.WRITE:
-            target_id = target_id if target_id else int.from_bytes(bytes([data[2], data[3]]), byteorder="big")
-            value_bytes = data[4:]
-        else:
-            value_bytes = data[2:]
+    await mqtt.subscribe("homeassistant/status")
+    for site in sites:
+        await mqtt.subscribe(site.command_topic)
+    await mqtt.subscribe("avionmqtt")
 
-        logger.info(f"mesh: target_id({target_id}), verb({verb}), noun({noun}), value:{value_bytes})")
+    tasks = {asyncio.create_task(site_run(mqtt, scanner, site, settings)) for site in sites}
+    tasks.add(asyncio.create_task(discovery.run()))
+    tasks.add(asyncio.create_task(mqtt_consume(mqtt, discovery, sites)))
+    try:
+        # the sites only stop on an mqtt error, so whatever stops first ends this connection
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def mqtt_run(
+    mqtt: aiomqtt.Client, scanner: MeshScanner, discovery: DiscoveryPublisher, sites: List[Site], settings: dict
+):
+    """Runs the bridge, connecting to mqtt again whenever the connection is lost."""
+    while True:
+        try:
+            print("connecting to MQTT and mesh")
+            logger.info("mqtt: Connecting to broker")
+            async with mqtt:
+                STARTUP.mark("mqtt")
+                logger.info("mesh: Connecting to mesh")
+                await bridge_run(mqtt, scanner, discovery, sites, settings)
 
-        if noun == Noun.DIMMING:
-            brightness = int.from_bytes(value_bytes[1:2], byteorder="big")
-            return {"avid": target_id, "brightness": brightness}
-        elif noun == Noun.COLOR:
-            temp = int.from_bytes(value_bytes[2:4], byteorder="big")
-            return {"avid": target_id, "color_temp": temp}
-        else:
-            logger.warning(f"unknown noun {noun}")
-    except Exception as e:
-        logger.exception(f"mesh: Exception parsing {data} from {target_id}")
-
-
-# BLEBridge.decryptMessage
-def mesh_parse_command(source: int, data: bytearray):
-    hex = "-".join(map(lambda b: format(b, "01x"), data))
-    logger.info(f"mesh: parsing notification {hex}")
-    if data[2] == 0x73:
-        if data[0] == 0x0 and data[1] == 0x80:
-            return mesh_parse_data(source, data[3:])
-        else:
-            return mesh_parse_data(int.from_bytes(bytes([data[1], data[0]]), byteorder="big"), data[3:])
-    else:
-        logger.warning(f"Unable to handle {data[2]}")
+        except aiomqtt.MqttError:
+            logger.warning(f"mqtt: Connection lost; Reconnecting in {MQTT_RETRY_INTERVAL} seconds ...")
+            await asyncio.sleep(MQTT_RETRY_INTERVAL)
 
+        except Exception:
+            logger.exception("mesh: Exception")
+            await asyncio.sleep(MQTT_RETRY_INTERVAL)
 
-async def mesh_read_all(mesh: BleakClient, key: str):
-    packet = create_packet(0, Verb.READ, Noun.DIMMING, bytearray(3))
-    await mesh_write_gatt(mesh, packet, key)
+        finally:
+            logger.info("mqtt: Done")
 
 
-async def mesh_subscribe(mqtt: aiomqtt.Client, mesh: BleakClient, key: str):
-    async def cb(characteristic: BleakGATTCharacteristic, data: bytearray):
-        # Log raw BLE
-        await handle_ble_notification(characteristic.uuid, data)
+async def bridge_shutdown(mqtt: aiomqtt.Client, sites: List[Site], bridge: asyncio.Task, settings: dict):
+    """
+    Stops the bridge within `timeout` seconds: the lights are marked offline and no new commands are taken in, the
+    commands already queued get up to `drain` seconds to reach the mesh, then the mesh and mqtt connections are closed.
+    """
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    deadline = started + settings.get("timeout", SHUTDOWN_TIMEOUT)
+    for site in sites:
+        site.stopping = True
 
-        # Process Avi-on mesh packets
-        if characteristic.uuid == CHARACTERISTIC_LOW:
-            mesh.low_bytes = data
-        elif characteristic.uuid == CHARACTERISTIC_HIGH:
-            encrypted = bytes([*mesh.low_bytes, *data])
-            decoded = csrmesh.crypto.decrypt_packet(key, encrypted)
-            parsed = mesh_parse_command(decoded["source"], decoded["decpayload"])
-            if parsed:
-                await mqtt_send_state(mqtt, parsed)
+    # one retained message takes every light offline, as their availability includes the bridge's (without it, the
+    # broker still publishes the last will once the connection is gone)
+    try:
+        await asyncio.wait_for(
+            asyncio.gather(
+                mqtt.publish(MQTT_AVAILABILITY_TOPIC, "offline", retain=True),
+                *(mqtt.unsubscribe(site.command_topic) for site in sites),
+            ),
+            deadline - loop.time(),
+        )
+    except (aiomqtt.MqttError, asyncio.TimeoutError):
+        logger.warning("mqtt: Unable to publish offline")
 
-    await mesh.start_notify(CHARACTERISTIC_LOW, cb)
-    await mesh.start_notify(CHARACTERISTIC_HIGH, cb)
+    drain_until = min(deadline, loop.time() + settings.get("drain", SHUTDOWN_DRAIN))
+    while not all(site.drained() for site in sites) and loop.time() < drain_until:
+        await asyncio.sleep(0.05)
+    if not all(site.drained() for site in sites):
+        logger.warning("mesh: Dropping commands that weren't written in time")
 
-    logger.info("mesh: reading all")
-    await mesh_read_all(mesh, key)
+    # the mesh pools disconnect from their nodes as they're cancelled, and mqtt disconnects after them
+    bridge.cancel()
+    await asyncio.wait({bridge}, timeout=max(deadline - loop.time(), 0))
+    if not bridge.done():
+        logger.warning("mesh: Unable to disconnect in time")
+    logger.info(f"Shut down in {loop.time() - started:.1f} seconds")
 
 
 def apply_overrides_from_settings(settings: dict):
@@ -441,127 +671,222 @@ def apply_overrides_from_settings(settings: dict):
         if color_temp_overrides is not None:
             for product_id in color_temp_overrides:
                 CAPABILITIES["color_temp"].add(product_id)
+        fade_overrides = capabilities_overrides.get("fade")
+        if fade_overrides is not None:
+            for product_id in fade_overrides:
+                CAPABILITIES["fade"].add(product_id)
+
+
+def sites_update_device_list(sites: List[Site]):
+    # Populate device list for the webserver
+    device_list.clear()
+    for site in sites:
+        for device in site.location["devices"]:
+            device_list.append(
+                {
+                    "name": device.get("name"),
+                    "mac_address": device.get("mac_address"),
+                    "product_id": device.get("product_id"),
+                    "location": site.name,
+                }
+            )
+
+
+async def snapshot_run(path: str, sites: List[Site], interval: float):
+    saved = None
+    while True:
+        await asyncio.sleep(interval)
+        saved = snapshot_write(path, sites, saved)
+
+
+def snapshot_write(path: str, sites: List[Site], saved: Optional[str] = None) -> str:
+    """Writes the snapshot unless it's the same as `saved`, returning what is on disk now."""
+    data = snapshot_dumps({site.prefix: site.snapshot() for site in sites})
+    if data != saved:
+        snapshot_save(path, data)
+    return data
+
+
+async def inventory_fetch(avion_settings: dict) -> List[dict]:
+    # only needed without a fresh cache, so the cloud client (and aiohttp) isn't loaded on every start
+    from avionhttp import HTTP_HOST, http_list_devices
+
+    return await http_list_devices(
+        avion_settings["email"], avion_settings["password"], avion_settings.get("host", HTTP_HOST)
+    )
+
+
+async def inventory_get(avion_settings: dict, cache_path: str) -> Tuple[List[dict], float]:
+    """Returns the locations with their age in seconds: the cached ones, or fetched (and cached) if there are none."""
+    locations, age = inventory_load(cache_path)
+    if locations is None:
+        logger.info("avion: Fetching devices")
+        locations = await inventory_fetch(avion_settings)
+        inventory_save(cache_path, locations)
+        age = 0
+    else:
+        logger.info(f"avion: Using devices cached {int(age)} seconds ago")
+    return locations, age
+
+
+async def inventory_refresh(settings: dict, sites: List[Site], discovery: DiscoveryPublisher, cache_path: str):
+    avion_settings = settings["avion"]
+    while True:
+        try:
+            logger.info("avion: Refreshing devices")
+            locations = await inventory_fetch(avion_settings)
+            break
+        except Exception:
+            logger.warning(f"avion: Unable to refresh devices; Retrying in {INVENTORY_RETRY_INTERVAL} seconds ...")
+            await asyncio.sleep(INVENTORY_RETRY_INTERVAL)
+
+    inventory_save(cache_path, locations)
+    # the cloud doesn't promise to list locations in the same order every time
+    by_pid = {location["pid"]: location for location in locations}
+    if by_pid.keys() != {site.location["pid"] for site in sites}:
+        logger.warning("avion: Locations were added or removed, restart the bridge to pick them up")
+
+    unchanged = True
+    for site in sites:
+        location = by_pid.get(site.location["pid"])
+        if location is None or location == site.location:
+            continue
+        unchanged = False
+        logger.info(f"avion: Devices of {site.name} changed, updating registrations")
+        # update in place, so the next mesh pipeline of the site picks up the new devices, groups and passphrase
+        site.location.update(location)
+        site.key = mesh_key(site.location["passphrase"])
+        packet_templates_prepare(location_avids(site.location))
+        old_discovery = site.discovery
+        site.discovery = discovery_messages(settings, site.location, site.prefix)
+        # only what was added, changed or removed actually gets published
+        discovery.publish(site.discovery, old_discovery.keys() - site.discovery.keys())
+        # the running pipeline holds on to the old key, groups and capabilities
+        site.reload.set()
+    if unchanged:
+        logger.info("avion: Devices unchanged")
+    sites_update_device_list(sites)
+
+
+async def webserver_run(settings: dict):
+    started = time.perf_counter()
+    # the web UI is optional, so aiohttp is only loaded when it's enabled, and off the event loop so it doesn't hold up
+    # connecting to mqtt
+    loop = asyncio.get_running_loop()
+    webserver = await loop.run_in_executor(None, importlib.import_module, ".webserver", __name__)
+    await webserver.start_webserver(
+        device_list, settings.get("host", webserver.WEB_HOST), settings.get("port", webserver.WEB_PORT)
+    )
+    STARTUP.mark("webserver", started)
+
+
+def background_done(task: asyncio.Task):
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Background task {task.get_name()} failed", exc_info=task.exception())
+
+
+def background_start(coroutine: Awaitable) -> asyncio.Task:
+    """Runs `coroutine` alongside the bridge, for as long as it lasts, logging it if it fails."""
+    task = asyncio.create_task(coroutine)
+    background_tasks.add(task)
+    task.add_done_callback(background_done)
+    return task
 
-async def shutdown_handler(mqtt: aiomqtt.Client, devices: list):
-    logger.info("Shutting down, setting devices offline...")
-    for device in devices:
-        avid = device["mac_address"].lower().replace(":", "")
-        await mqtt.publish(
-            f"hmd/light/avid/{avid}/availability",
-            "offline",
-            retain=True,
-        )
 
 async def main():
+    STARTUP.mark("imports")
     parser = ArgumentParser()
     parser.add_argument("-s", "--settings", dest="settings", help="yaml file to read settings from", metavar="FILE")
-    parser.add_argument("--log", default="WARNING", help="Set the logging level (DEBUG, INFO, WARNING, ERROR, CRITICAL)")
+    parser.add_argument(
+        "--log", default="WARNING", help="Set the logging level (DEBUG, INFO, WARNING, ERROR, CRITICAL)"
+    )
+    parser.add_argument(
+        "--profile-startup",
+        action="store_true",
+        help="print how long each startup phase takes (see python -X importtime for the imports by module)",
+    )
     args = parser.parse_args()
 
     logging.basicConfig(level=args.log.upper(), format="%(levelname)s: %(message)s")
+    if args.profile_startup:
+        STARTUP.enable()
 
     settings = settings_get(args.settings)
+    STARTUP.mark("settings")
     apply_overrides_from_settings(settings)
     avion_settings = settings["avion"]
     email = avion_settings["email"]
-    password = avion_settings["password"]
     mqtt_settings = settings["mqtt"]
 
-    logger.info("avion: Fetching devices")
-    locations = await http_list_devices(email, password)
-    assert len(locations) == 1
-    location = locations[0]
-    passphrase = location["passphrase"]
-
-    # Populate device list for the webserver
-    device_list.clear()
-    for device in location["devices"]:
-        device_list.append({
-            "name": device.get("name"),
-            "mac_address": device.get("mac_address"),
-            "product_id": device.get("product_id"),
-        })
-
-    print(f"Resolved devices for {email} with passphrase {passphrase}")
-
-    target_devices = [d["mac_address"].lower() for d in location["devices"]]
+    cache_settings = avion_settings.get("cache", {})
+    cache_path = cache_settings.get("path", inventory_default_path(args.settings))
+    locations, age = await inventory_get(avion_settings, cache_path)
+    STARTUP.mark("inventory")
 
+    # one mqtt connection is shared by the meshes of all locations
     mqtt = aiomqtt.Client(
         hostname=mqtt_settings["host"],
         username=mqtt_settings["username"],
         password=mqtt_settings["password"],
+        will=aiomqtt.Will(MQTT_AVAILABILITY_TOPIC, "offline", retain=True),
     )
 
-    running = True
+    sites = []
+    state_settings = settings.get("state", {})
+    min_interval = state_settings.get("min_interval", DEFAULT_MIN_INTERVAL)
+    snapshot_path = state_settings.get("snapshot_path", snapshot_default_path(args.settings))
+    snapshot = snapshot_load(snapshot_path)
+    for index, location in enumerate(locations):
+        prefix = location_topic_prefix(location, index, len(locations))
+        # the state store outlives both mqtt and mesh reconnects, so we only ever publish real changes
+        states = StateStore(mqtt, min_interval, f"{prefix}/{{avid}}/state")
+        site = Site(location, prefix, states, settings)
+        site.restore(snapshot.get(prefix, {}))
+        sites.append(site)
+        print(f"Resolved devices of {site.name} for {email} with passphrase {location['passphrase']}")
+    sites_update_device_list(sites)
+    discovery = DiscoveryPublisher(mqtt)
+    STARTUP.mark("sites")
+
+    if age > cache_settings.get("ttl", INVENTORY_TTL):
+        # start from the cached inventory right away and catch up with the cloud in the background
+        background_start(inventory_refresh(settings, sites, discovery, cache_path))
+
+    # scan from the start, so by the time mqtt is up (and after any disconnect) the strongest nodes are already known
+    scanner = MeshScanner()
+    background_start(scanner.run())
+
+    background_start(snapshot_run(snapshot_path, sites, state_settings.get("snapshot_interval", SNAPSHOT_INTERVAL)))
+
+    web_settings = settings.get("web", {})
+    if web_settings.get("enabled", True):
+        background_start(webserver_run(web_settings))
+
+    bridge = asyncio.create_task(mqtt_run(mqtt, scanner, discovery, sites, settings))
 
-    # Start the Flask webserver in background
-    threading.Thread(target=start_webserver, daemon=True).start()
-
-    # Add shutdown signal handlers
     loop = asyncio.get_running_loop()
-    for sig in (signal.SIGINT, signal.SIGTERM):
-        loop.add_signal_handler(
-            sig, lambda: asyncio.create_task(shutdown_handler(mqtt, device_list))
-        )
+    stopping = asyncio.Event()
 
-    # connect to mqtt
-    while running:
-        try:
-            print("connecting to MQTT and mesh")
-            logger.info("mqtt: Connecting to broker")
-            async with mqtt:
-                # register the lights
-                await mqtt_register_lights(settings, location, mqtt)
-                # now connect the mesh
-                logger.info("mesh: Connecting to mesh")
-                while running:
-                    try:
-                        mesh = None
-                        logger.info("mesh: Scanning for devices")
-                        for mac in set(await mac_ordered_by_rssi()).intersection(target_devices):
-                            logger.info(f"mesh: connecting to {mac}")
-                            try:
-                                ble_device = await BleakScanner.find_device_by_address(mac)
-                                if ble_device is None:
-                                    logger.info(f"mesh: Could not find {mac}, moving on to the next device")
-                                    continue
-                                mesh = BleakClient(mac)
-                                await mesh.connect()
-                            except BleakError:
-                                logger.warning(f"mesh: Error connecting to {mac}")
-                                continue
-                            except Exception:
-                                logger.warning(f"mesh: Error connecting to {mac}")
-                                continue
-                            logger.info(f"mesh: Connected to {mac}")
-                            print("Connected to MQTT and mesh")
-                            key = csrmesh.crypto.generate_key(passphrase.encode("ascii") + b"\x00\x4d\x43\x50")
-                            # subscribe to updates from the mesh
-                            await mesh_subscribe(mqtt, mesh, key)
-                            # subscribe to commands from mqtt (this also keeps the loop going)
-                            await mqtt_subscribe(mqtt, mesh, key, settings, location)
-
-                    except asyncio.CancelledError:
-                        running = False
-                        print("Terminating")
-
-                    except BleakError:
-                        logger.warning("mesh: Error connecting to device")
-
-                    except Exception:
-                        logger.exception("mesh: Exception")
-
-                    finally:
-                        logger.info("mesh: Done")
-                        if mesh and mesh.is_connected:
-                            await mesh.disconnect()
-                            logger.info(f"mesh: Disconnected from {mac}")
+    def stop():
+        if stopping.is_set():
+            # a second signal doesn't wait for the rest of the shutdown
+            loop.stop()
+        stopping.set()
 
-        except aiomqtt.MqttError:
-            logger.warning(f"mqtt: Connection lost; Reconnecting in {MQTT_RETRY_INTERVAL} seconds ...")
-            await asyncio.sleep(MQTT_RETRY_INTERVAL)
-        finally:
-            logger.info("mqtt: Done")
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop)
 
-# create a new event loop (low-level api)
-run(main())
+    try:
+        await stopping.wait()
+        print("Terminating")
+        await bridge_shutdown(mqtt, sites, bridge, settings.get("shutdown", {}))
+    finally:
+        snapshot_write(snapshot_path, sites)
+    # aiorun cancels whatever is left (scanning, snapshots, the web UI) and exits
+    loop.stop()
+
+
+def cli():
+    # create a new event loop (low-level api)
+    run(main())
@@ -0,0 +1,279 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, FrozenSet, Hashable, List, Optional, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+# the parts of a Home Assistant json-schema command that we know how to forward to the mesh
+COMMAND_KEYS = ("state", "brightness", "color_temp", "transition")
+
+# lower values are dispatched first
+PRIORITY_SWITCH = 0
+PRIORITY_DIMMING = 1
+PRIORITY_COLOR_TEMP = 2
+PRIORITY_BACKGROUND = 3
+PRIORITY_LEVELS = 4
+
+# the brightness a bare state stands for
+SWITCH_BRIGHTNESS = {"ON": 255, "OFF": 0}
+
+OVERFLOW_DROP_OLDEST = "drop_oldest"
+OVERFLOW_DROP_NEWEST = "drop_newest"
+OVERFLOW_POLICIES = (OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST)
+
+DEFAULT_QUEUE_DEPTH = 256
+DEFAULT_GROUP_WINDOW = 0.05
+
+Job = Callable[[], Awaitable]
+
+
+def command_brightness(payload: dict) -> Optional[int]:
+    """
+    Returns the brightness a command asks for, or None when it leaves brightness alone. Home Assistant sends
+    "state": "ON" along with every change to a light that is on, so that only means full brightness on its own.
+    """
+    if "brightness" in payload:
+        return payload["brightness"]
+    state = payload.get("state")
+    if state == "OFF":
+        return 0
+    if state == "ON" and "color_temp" not in payload:
+        return 255
+    return None
+
+
+def command_merge(pending: dict, payload: dict) -> dict:
+    """Merges a newer command into a pending one, letting the newest intent win."""
+    merged = dict(pending)
+    # what the pending state means is settled before a newer color_temp joins it and changes that meaning
+    brightness = command_brightness(pending)
+    if brightness is not None:
+        merged["brightness"] = brightness
+    # state and brightness both end up as a single DIMMING write, so a newer value for either replaces both, but a
+    # state that comes along with a color_temp doesn't ask for a brightness and leaves the pending one alone
+    if command_brightness(payload) is not None:
+        merged.pop("state", None)
+        merged.pop("brightness", None)
+    # a transition only applies to the command it came with
+    merged.pop("transition", None)
+    for k in COMMAND_KEYS:
+        if k in payload and not (k == "state" and k in merged):
+            merged[k] = payload[k]
+    return merged
+
+
+def command_validate(payload) -> dict:
+    """
+    Returns the parts of a command that we know how to forward, with brightness and color_temp as whole numbers.
+    Raises ValueError for a command that doesn't make sense, rather than letting it fail on its way to the mesh.
+    """
+    if not isinstance(payload, dict):
+        raise ValueError(f"expected an object, got {payload!r}")
+    command = {key: payload[key] for key in COMMAND_KEYS if key in payload}
+    for key, value in command.items():
+        if key == "state":
+            if value not in SWITCH_BRIGHTNESS:
+                raise ValueError(f"state {value!r}")
+            continue
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError(f"{key} {value!r}")
+        if key == "brightness" and not 0 <= value <= 255:
+            raise ValueError(f"brightness {value}")
+        if key == "color_temp" and value <= 0:
+            raise ValueError(f"color_temp {value}")
+        if key == "transition" and value < 0:
+            raise ValueError(f"transition {value}")
+        if key != "transition":
+            command[key] = round(value)
+    return command
+
+
+def command_priority(payload: dict) -> int:
+    """
+    Classifies a command by what it does, not by its keys: Home Assistant sends "state" along with every change, so
+    only turning a light on or off (which merging may have spelled out as a brightness) is a switch.
+    """
+    brightness = command_brightness(payload)
+    if brightness is None:
+        return PRIORITY_COLOR_TEMP
+    if brightness == SWITCH_BRIGHTNESS.get(payload.get("state")):
+        return PRIORITY_SWITCH
+    return PRIORITY_DIMMING
+
+
+class CommandScheduler:
+    """
+    Sits between MQTT intake and the mesh. Light commands are coalesced per avid (newest intent wins) and everything
+    is dispatched by priority from a bounded queue, so submitting never blocks the caller.
+
+    When `groups` (group avid -> member avids) is given, a command for a group member that another member of the
+    group has a command pending alongside is held for up to `group_window` seconds, and if every member of a group
+    ends up with the same pending command they are sent as a single group packet instead. `send` is then called with
+    the group avid and the members it stands in for.
+    """
+
+    def __init__(
+        self,
+        send: Callable[[int, dict, Tuple[int, ...]], Awaitable],
+        depth: int = DEFAULT_QUEUE_DEPTH,
+        overflow: str = OVERFLOW_DROP_OLDEST,
+        groups: Dict[int, FrozenSet[int]] = None,
+        group_window: float = DEFAULT_GROUP_WINDOW,
+    ):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy {overflow}, expected one of {OVERFLOW_POLICIES}")
+        self._send = send
+        self._depth = depth
+        self._overflow = overflow
+        self._queues: List[OrderedDict] = [OrderedDict() for _ in range(PRIORITY_LEVELS)]
+        self._priorities = {}
+        self._submitted: Dict[Hashable, float] = {}
+        self._wakeup = asyncio.Event()
+        self._group_window = group_window
+        # for each avid, the groups it is part of, largest first so a collapse saves as many writes as possible
+        self._groups_of: Dict[int, List[Tuple[int, FrozenSet[int]]]] = {}
+        for group_avid, members in sorted((groups or {}).items(), key=lambda g: -len(g[1])):
+            if len(members) < 2:
+                continue
+            for member in members:
+                self._groups_of.setdefault(member, []).append((group_avid, members))
+        self.dropped = 0
+        self.collapsed = 0
+
+    def __len__(self) -> int:
+        return len(self._priorities)
+
+    def submit_command(self, avid: int, payload: dict) -> bool:
+        pending = self._get(avid)
+        if pending is not None:
+            logger.debug(f"commands: coalescing {payload} into {pending} for {avid}")
+        merged = command_merge(pending or {}, payload)
+        return self._put(avid, command_priority(merged), merged)
+
+    def submit(self, key: Hashable, priority: int, job: Job) -> bool:
+        """Schedules a job, replacing any job still pending under the same key."""
+        return self._put(key, priority, job)
+
+    def cancel(self, key: Hashable) -> bool:
+        """Drops whatever is still pending under `key`."""
+        if key not in self._priorities:
+            return False
+        self._remove(key)
+        return True
+
+    def _get(self, key: Hashable):
+        priority = self._priorities.get(key)
+        return None if priority is None else self._queues[priority][key]
+
+    def _remove(self, key: Hashable):
+        priority = self._priorities.pop(key)
+        del self._queues[priority][key]
+        self._submitted.pop(key, None)
+
+    def _put(self, key: Hashable, priority: int, entry: Union[dict, Job]) -> bool:
+        current = self._priorities.get(key)
+        if current == priority:
+            # updating in place keeps the key's position in line, so a target being dragged isn't starved
+            self._queues[priority][key] = entry
+            # a held group may be complete now
+            self._wakeup.set()
+            return True
+        if current is not None:
+            self._remove(key)
+        elif len(self._priorities) >= self._depth and not self._make_room(priority):
+            self.dropped += 1
+            logger.warning(f"commands: queue full, dropping {key}")
+            return False
+
+        self._queues[priority][key] = entry
+        self._priorities[key] = priority
+        self._submitted.setdefault(key, time.monotonic())
+        self._wakeup.set()
+        return True
+
+    def _make_room(self, priority: int) -> bool:
+        if self._overflow == OVERFLOW_DROP_NEWEST:
+            return False
+        # evict the oldest entry of the least important level, but never in favour of something less important
+        for level in range(PRIORITY_LEVELS - 1, priority - 1, -1):
+            if self._queues[level]:
+                key = next(iter(self._queues[level]))
+                self._remove(key)
+                self.dropped += 1
+                logger.warning(f"commands: queue full, dropping oldest {key}")
+                return True
+        return False
+
+    def _next(self) -> Tuple[Optional[Tuple[Hashable, Union[dict, Job]]], Optional[float]]:
+        """
+        Returns the first entry, by priority, that can be dispatched now. When every pending entry is held for its
+        group, returns None along with how long until the first hold ends (None when there is nothing pending at all).
+        """
+        wait = None
+        for queue in self._queues:
+            for key, entry in queue.items():
+                if callable(entry) or key not in self._groups_of:
+                    return (key, entry), None
+                held = self._group_wait(key, entry)
+                if held <= 0:
+                    return (key, entry), None
+                wait = held if wait is None else min(wait, held)
+        return None, wait
+
+    def _group_complete(self, members: FrozenSet[int], entry: dict) -> bool:
+        return all(self._get(member) == entry for member in members)
+
+    def _group_wait(self, avid: int, entry: dict) -> float:
+        """
+        Returns how much longer to hold a grouped command so the rest of its group can catch up. That is only worth it
+        when another member of one of its groups has a command pending too, a lone command goes out right away.
+        """
+        remaining = self._submitted[avid] + self._group_window - time.monotonic()
+        if remaining <= 0:
+            return 0
+        pending = False
+        for _, members in self._groups_of[avid]:
+            if self._group_complete(members, entry):
+                return 0
+            pending = pending or any(member != avid and member in self._priorities for member in members)
+        return remaining if pending else 0
+
+    def _collapse(self, avid: int, entry: dict) -> Tuple[int, Tuple[int, ...]]:
+        for group_avid, members in self._groups_of.get(avid, ()):
+            if self._group_complete(members, entry):
+                for member in members:
+                    self._remove(member)
+                self.collapsed += len(members) - 1
+                logger.info(f"commands: collapsed {len(members)} commands into group {group_avid}")
+                return group_avid, tuple(sorted(members))
+        self._remove(avid)
+        return avid, ()
+
+    async def _hold(self, timeout: Optional[float]):
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def run(self):
+        while True:
+            # grouped commands being held don't hold up anything else
+            item, wait = self._next()
+            if item is None:
+                await self._hold(wait)
+                continue
+            key, entry = item
+            # whatever goes wrong with one entry, the rest of the queue still goes out
+            try:
+                if callable(entry):
+                    self._remove(key)
+                    await entry()
+                    continue
+
+                target, members = self._collapse(key, entry)
+                await self._send(target, entry, members)
+            except Exception:
+                logger.exception(f"commands: Unable to dispatch {key}")
@@ -0,0 +1,175 @@
+import asyncio
+import hashlib
+import json
+import logging
+import re
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import aiomqtt
+
+logger = logging.getLogger(__name__)
+
+MQTT_TOPIC_PREFIX = "hmd/light/avid"
+# online while the bridge is connected, the last will of its mqtt connection sets it offline
+MQTT_AVAILABILITY_TOPIC = "avionmqtt/availability"
+DISCOVERY_CONCURRENCY = 16
+
+CAPABILITIES = {
+    "dimming": {0, 90, 93, 94, 97, 134, 137, 162},
+    "color_temp": {0, 93, 134, 137, 162},
+    # products that fade by themselves (FADE_TIME), the others get stepped fades
+    "fade": set(),
+}
+PRODUCT_NAMES = {
+    0: "Group",
+    90: "Lamp Dimmer",
+    93: "Recessed Downlight (RL)",
+    94: "Light Adapter",
+    97: "Smart Dimmer",
+    134: "Smart Bulb (A19)",
+    137: "Surface Downlight (BLD)",
+    162: "MicroEdge (HLB)",
+    167: "Smart Switch",
+}
+
+
+def mqtt_discovery_config(
+    use_single_device: bool, entity: dict, prefix: str = MQTT_TOPIC_PREFIX, scope: Optional[str] = None
+) -> Tuple[str, str]:
+    product_id = entity["product_id"]
+    pid = entity["pid"]
+    avid = entity["avid"]
+    name = entity["name"]
+    # names (and the "all" entity) repeat between locations, so with more than one the location `scope`s them
+    unique_id = pid if scope is None else f"{scope}_{pid}"
+
+    # https://www.home-assistant.io/integrations/light.mqtt/
+    config = {
+        "component": "light",
+        "object_id": f"avid_{avid}",
+        "unique_id": unique_id,
+        "schema": "json",
+        "payload_off": "OFF",
+        "payload_on": "ON",
+        "brightness": product_id in CAPABILITIES["dimming"],
+        "color_mode": product_id in CAPABILITIES["color_temp"],
+        "effect": False,
+        # only available while both the bridge and the light are
+        "availability_mode": "all",
+        "availability": [{"topic": MQTT_AVAILABILITY_TOPIC}, {"topic": f"{prefix}/{avid}/availability"}],
+        "state_topic": f"{prefix}/{avid}/state",
+        "json_attributes_topic": f"{prefix}/{avid}/attributes",
+        "command_topic": f"{prefix}/{avid}/command",
+    }
+
+    if use_single_device:
+        config["name"] = name
+        config["device"] = {"identifiers": ["avionmqtt"], "name": "Avi-on MQTT Bridge"}
+    else:
+        config["device"] = {
+            "identifiers": [unique_id],
+            "name": name,
+            "manufacturer": "Avi-on",
+            "model": PRODUCT_NAMES.get(product_id, f"Unknown product ({product_id})"),
+            "serial_number": pid,
+        }
+
+    # Fix object_id based on light name
+    friendly_name = name or f"Avi-on Light {avid}"
+    object_id = friendly_name if scope is None else f"{scope} {friendly_name}"
+    object_id = re.sub(r"[^a-z0-9_]", "", object_id.lower().replace(" ", "_"))
+
+    config["object_id"] = object_id
+    config["name"] = friendly_name
+
+    if product_id in CAPABILITIES["color_temp"]:
+        config["supported_color_modes"] = ["color_temp"]
+
+    return f"homeassistant/light/{object_id}/config", json.dumps(config)
+
+
+def mqtt_select_category(settings: dict, list: List[dict], exclude: set = frozenset()) -> List[dict]:
+    if not settings["import"]:
+        return []
+    include = settings.get("include", None)
+    exclude = set(settings.get("exclude") or ()) | exclude
+    return [e for e in list if (include is not None and e["pid"] in include) or e["pid"] not in exclude]
+
+
+def mqtt_select_entities(settings: dict, location: dict) -> List[dict]:
+    entities = mqtt_select_category(settings["groups"], location["groups"])
+
+    exclude = set()
+    if settings["devices"].get("exclude_in_group"):
+        for group in location["groups"]:
+            exclude |= set(group["devices"])
+    entities += mqtt_select_category(settings["devices"], location["devices"], exclude)
+    if "all" in settings:
+        entities.append({"pid": "avion_all", "product_id": 0, "avid": 0, "name": settings["all"]["name"]})
+    return entities
+
+
+def discovery_messages(settings: dict, location: dict, prefix: str = MQTT_TOPIC_PREFIX) -> Dict[str, str]:
+    """Renders the retained messages (configs and availability) that announce the lights of a location, by topic."""
+    use_single_device = settings.get("single_device", False)
+    # a lone location keeps the default prefix and the ids it always had, more than one get a prefix each
+    scope = None if prefix == MQTT_TOPIC_PREFIX else str(location.get("pid", prefix))
+    messages = {}
+    for entity in mqtt_select_entities(settings, location):
+        topic, config = mqtt_discovery_config(use_single_device, entity, prefix, scope)
+        messages[topic] = config
+        messages[f"{prefix}/{entity['avid']}/availability"] = "online"
+    return messages
+
+
+def _digest(payload: str) -> bytes:
+    return hashlib.sha256(payload.encode()).digest()
+
+
+class DiscoveryPublisher:
+    """
+    Publishes discovery messages from its own task, at most `concurrency` at a time, so announcing a few hundred lights
+    never holds up commands. The hash of every message published on the current connection is kept, and messages
+    whose content didn't change since are skipped (they're retained, so the broker still has them).
+
+    `reset` forgets those hashes, for when a new connection is made (the broker may have lost its retained messages).
+    """
+
+    def __init__(self, mqtt: aiomqtt.Client, concurrency: int = DISCOVERY_CONCURRENCY):
+        self._mqtt = mqtt
+        self._concurrency = concurrency
+        self._published: Dict[str, bytes] = {}
+        self._pending: Dict[str, str] = {}
+        self._wakeup = asyncio.Event()
+        self.skipped = 0
+
+    def reset(self):
+        self._published.clear()
+
+    def publish(self, messages: Dict[str, str], removed: Iterable[str] = ()):
+        """Queues the messages that changed since they were last published, and clears the `removed` topics."""
+        for topic, payload in messages.items():
+            if self._published.get(topic) == _digest(payload):
+                self.skipped += 1
+                continue
+            self._pending[topic] = payload
+        for topic in removed:
+            # an empty retained message removes the entity from Home Assistant (and clears its availability)
+            self._pending[topic] = ""
+        if self._pending:
+            self._wakeup.set()
+
+    async def _publish(self, semaphore: asyncio.Semaphore, topic: str, payload: str):
+        async with semaphore:
+            await self._mqtt.publish(topic, payload, retain=True)
+        self._published[topic] = _digest(payload)
+
+    async def run(self):
+        semaphore = asyncio.Semaphore(self._concurrency)
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            pending, self._pending = self._pending, {}
+            logger.info(f"mqtt: Publishing {len(pending)} discovery messages ({self.skipped} unchanged)")
+            self.skipped = 0
+            await asyncio.gather(*(self._publish(semaphore, topic, payload) for topic, payload in pending.items()))
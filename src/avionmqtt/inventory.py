@@ -0,0 +1,40 @@
+import json
+import logging
+import os
+import time
+from typing import List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+INVENTORY_FILE = "inventory.json"
+INVENTORY_TTL = 24 * 60 * 60
+INVENTORY_RETRY_INTERVAL = 60
+
+
+def inventory_default_path(settings_file: str) -> str:
+    return os.path.join(os.path.dirname(os.path.abspath(settings_file)), INVENTORY_FILE)
+
+
+def inventory_load(path: str) -> Tuple[Optional[List[dict]], float]:
+    """Returns the cached locations along with their age in seconds, or None if there is no usable cache."""
+    try:
+        with open(path) as stream:
+            cached = json.load(stream)
+        return cached["locations"], time.time() - cached["fetched_at"]
+    except FileNotFoundError:
+        return None, float("inf")
+    except (OSError, ValueError, KeyError, TypeError):
+        logger.warning(f"avion: Ignoring unreadable inventory cache {path}")
+        return None, float("inf")
+
+
+def inventory_save(path: str, locations: List[dict]):
+    # the cache holds the mesh passphrase, so keep it private and never leave a half written file behind
+    temp_path = path + ".tmp"
+    try:
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as stream:
+            json.dump({"fetched_at": time.time(), "locations": locations}, stream)
+        os.replace(temp_path, path)
+    except OSError:
+        logger.warning(f"avion: Unable to write inventory cache {path}")
@@ -0,0 +1,27 @@
+from typing import List, Tuple
+
+LOG_SIZE = 500
+
+
+class LogBuffer:
+    """
+    Fixed size ring buffer of log lines. Every line gets an increasing sequence number, so readers can ask for
+    everything after the last line they saw. Only ever touched from the event loop, so no locking is needed.
+    """
+
+    def __init__(self, size: int):
+        self._lines = [None] * size
+        self._size = size
+        self.cursor = 0
+
+    def append(self, text: str):
+        self._lines[self.cursor % self._size] = text
+        self.cursor += 1
+
+    def since(self, cursor: int) -> Tuple[List[str], int]:
+        """Returns the lines appended after `cursor` (as far as they're still buffered) and the new cursor."""
+        start = max(cursor, self.cursor - self._size, 0)
+        return [self._lines[i % self._size] for i in range(start, self.cursor)], self.cursor
+
+
+LOG_BUFFER = LogBuffer(LOG_SIZE)
@@ -0,0 +1,448 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+import csrmesh
+from bleak import BleakClient, BleakScanner
+from bleak.backends.device import BLEDevice
+from bleak.backends.scanner import AdvertisementData
+from bleak.exc import BleakError
+
+from .metrics import BLE_RECONNECT_SECONDS, BLE_RECONNECTS, BLE_SCAN_SECONDS, MESH_WRITE_FAILURES, MESH_WRITE_SECONDS
+from .notifications import NotificationPipeline
+from .protocol import Noun, packet_encode
+
+logger = logging.getLogger(__name__)
+
+CHARACTERISTIC_LOW = "c4edc000-9daf-11e3-8003-00025b000b00"
+CHARACTERISTIC_HIGH = "c4edc000-9daf-11e3-8004-00025b000b00"
+
+MESH_WRITE_RATE = 20
+MESH_WRITE_WINDOW = 8
+MESH_THROUGHPUT_SAMPLE = 50
+MESH_CONNECTIONS = 1
+MESH_POOL_RETRY_INTERVAL = 10
+MESH_SCAN_STALE = 30
+MESH_SCAN_RETRY_INTERVAL = 10
+
+
+def mesh_encrypt_packet(packet: bytes, key: str) -> Tuple[bytes, bytes]:
+    logger.debug("-".join(map(lambda b: format(b, "02x"), packet)))
+
+    csrpacket = csrmesh.crypto.make_packet(key, csrmesh.crypto.random_seq(), packet)
+    return csrpacket[:20], csrpacket[20:]
+
+
+def mesh_encrypt_batch(packets: Iterable[bytes], key: str) -> List[Tuple[bytes, bytes]]:
+    """
+    Encrypts `packets` in one go, each split into the low and high halves it's written in. Sequence numbers count up
+    from a single random one, so a batch never repeats one (the mesh drops a sequence number it has just seen).
+    """
+    make_packet = csrmesh.crypto.make_packet
+    seq = csrmesh.crypto.random_seq()
+    halves = []
+    for packet in packets:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(packet.hex("-"))
+        csrpacket = make_packet(key, seq, packet)
+        halves.append((csrpacket[:20], csrpacket[20:]))
+        seq = seq % 0xFFFFFF + 1
+    return halves
+
+
+def mesh_encode_batch(commands: Iterable[Tuple[int, Noun, int]], key: str) -> List[Tuple[bytes, bytes]]:
+    """Encodes and encrypts (avid, noun, value) commands, see `packet_encode`, ready to write."""
+    return mesh_encrypt_batch([packet_encode(avid, noun, value) for avid, noun, value in commands], key)
+
+
+async def mesh_write_gatt(mesh: BleakClient, packet: bytes, key: str, response: bool = True) -> bool:
+    low, high = mesh_encrypt_packet(packet, key)
+    await mesh.write_gatt_char(CHARACTERISTIC_LOW, low, response=response)
+    await mesh.write_gatt_char(CHARACTERISTIC_HIGH, high, response=response)
+    return True
+
+
+def mesh_supports_write_without_response(mesh: BleakClient) -> bool:
+    for uuid in (CHARACTERISTIC_LOW, CHARACTERISTIC_HIGH):
+        characteristic = mesh.services.get_characteristic(uuid)
+        if characteristic is None or "write-without-response" not in characteristic.properties:
+            return False
+    return True
+
+
+class MeshScanner:
+    """
+    Scans in the background for as long as the bridge runs, keeping the latest advertisement of every node it hears.
+    Connecting then never has to wait for a scan: candidates come straight from this table, strongest signal first,
+    with the BLEDevice bleak needs to connect directly. Advertisements older than `stale` seconds are ignored.
+    """
+
+    def __init__(self, stale: float = MESH_SCAN_STALE):
+        self._stale = stale
+        self._seen: Dict[str, Tuple[BLEDevice, int, float]] = {}
+        self._watchers: List[asyncio.Event] = []
+        self._started = 0.0
+        self._first = True
+
+    def _detected(self, device: BLEDevice, advertisement: AdvertisementData):
+        mac = device.address.lower()
+        now = time.monotonic()
+        previous = self._seen.get(mac)
+        self._seen[mac] = (device, advertisement.rssi, now)
+        if previous is None or now - previous[2] > self._stale:
+            if self._first:
+                self._first = False
+                BLE_SCAN_SECONDS.observe(now - self._started)
+            for event in self._watchers:
+                event.set()
+
+    def watch(self, event: asyncio.Event):
+        """Sets `event` whenever a node shows up that wasn't (recently) seen before."""
+        self._watchers.append(event)
+
+    def unwatch(self, event: asyncio.Event):
+        self._watchers.remove(event)
+
+    def candidates(self, targets: Set[str]) -> List[BLEDevice]:
+        """Returns the recently seen nodes out of `targets`, strongest signal first."""
+        now = time.monotonic()
+        seen = [
+            (rssi, device)
+            for mac, (device, rssi, seen_at) in self._seen.items()
+            if mac in targets and now - seen_at <= self._stale
+        ]
+        seen.sort(key=lambda s: s[0], reverse=True)
+        return [device for _, device in seen]
+
+    async def run(self):
+        """Scans until cancelled, starting over whenever the adapter can't be started."""
+        while True:
+            try:
+                await self._scan()
+            except Exception:
+                logger.exception(f"mesh: Scanning failed; Retrying in {MESH_SCAN_RETRY_INTERVAL} seconds ...")
+            await asyncio.sleep(MESH_SCAN_RETRY_INTERVAL)
+
+    async def _scan(self):
+        scanner = BleakScanner(detection_callback=self._detected)
+        self._started = time.monotonic()
+        await scanner.start()
+        logger.info("mesh: Scanning for devices")
+        try:
+            await asyncio.get_running_loop().create_future()
+        finally:
+            try:
+                await scanner.stop()
+            except Exception:
+                logger.warning("mesh: Unable to stop scanning")
+
+
+class MeshLink:
+    __slots__ = ("mac", "client", "response", "queue", "task", "waiter")
+
+    def __init__(self, mac: str, client: BleakClient, response: bool):
+        self.mac = mac
+        self.client = client
+        self.response = response
+        self.queue = deque()
+        self.task: Optional[asyncio.Task] = None
+        self.waiter: Optional[asyncio.Future] = None
+
+
+class MeshWriter:
+    """
+    Encrypts packets as they are submitted and writes them over one or more connected mesh nodes, keeping at most
+    `window` packets in flight and pacing them at `rate` packets per second (shared by all nodes, as they all feed the
+    same mesh) so the mesh doesn't drop them.
+
+    Packets are sharded over the nodes by their target, so commands for one light stay in order. The low/high halves
+    of a packet always go to the same node, back to back, as a node can't reassemble interleaved halves. When a write
+    fails, the node is dropped and its queued packets move to the remaining ones.
+
+    Unless `throughput` was already measured (by an earlier writer for the same mesh), it is measured over the first
+    `MESH_THROUGHPUT_SAMPLE` writes, counting only the time there were packets waiting to be written.
+    """
+
+    def __init__(
+        self,
+        key: str,
+        settings: dict = None,
+        on_lost: Callable[[str], None] = None,
+        throughput: Optional[float] = None,
+    ):
+        settings = settings or {}
+        self.key = key
+        self.rate = settings.get("write_rate", MESH_WRITE_RATE)
+        self._without_response = settings.get("write_without_response", True)
+        self._window = asyncio.Semaphore(settings.get("write_window", MESH_WRITE_WINDOW))
+        self._on_lost = on_lost
+        self._links: Dict[str, MeshLink] = {}
+        self._order: List[MeshLink] = []
+        # packets waiting for a node while none are connected
+        self._stranded = deque()
+        self._next_slot = 0.0
+        self._progress = asyncio.Event()
+        self.accepted = 0
+        self.written = 0
+        self.throughput = throughput
+        self._busy = 0.0
+        self._busy_since: Optional[float] = None
+
+    def __len__(self) -> int:
+        return len(self._links)
+
+    @property
+    def pending(self) -> int:
+        """Packets taken in that haven't been written yet."""
+        return sum(len(link.queue) for link in self._order) + len(self._stranded)
+
+    def add(self, mac: str, client: BleakClient):
+        response = not (self._without_response and mesh_supports_write_without_response(client))
+        link = MeshLink(mac, client, response)
+        self._links[mac] = link
+        self._order = sorted(self._links.values(), key=lambda link: link.mac)
+        link.task = asyncio.create_task(self._run(link))
+        logger.info(f"mesh: writing to {mac} {'acknowledged' if response else 'without response'}")
+        self._requeue(self._stranded)
+
+    def remove(self, mac: str):
+        link = self._links.pop(mac, None)
+        if link is None:
+            return
+        self._order = sorted(self._links.values(), key=lambda link: link.mac)
+        if link.task is not asyncio.current_task():
+            link.task.cancel()
+        if not self._order and self._busy_since is not None:
+            # waiting for a node to write to isn't part of the throughput
+            self._busy += asyncio.get_running_loop().time() - self._busy_since
+            self._busy_since = None
+        self._requeue(link.queue)
+
+    def _requeue(self, pending: deque):
+        while pending:
+            self._enqueue(*pending.popleft())
+
+    def _enqueue(self, shard: bytes, halves: Tuple[bytes, bytes]):
+        if not self._order:
+            self._stranded.append((shard, halves))
+            return
+        link = self._order[hash(shard) % len(self._order)]
+        link.queue.append((shard, halves))
+        if self.throughput is None and self._busy_since is None:
+            self._busy_since = asyncio.get_running_loop().time()
+        if link.waiter is not None and not link.waiter.done():
+            link.waiter.set_result(None)
+
+    async def write(self, packet: bytes) -> bool:
+        await self._window.acquire()
+        # the target (device and group bytes) decides which node carries the packet
+        shard = packet[:2] + packet[5:7]
+        # encrypting here means the next packet is ready while the previous one is still being written
+        self._enqueue(shard, mesh_encrypt_packet(packet, self.key))
+        self.accepted += 1
+        return True
+
+    async def write_many(self, packets: List[bytes]):
+        """Like `write`, but encrypts all of `packets` at once; they're queued in order as the window allows."""
+        for packet, halves in zip(packets, mesh_encrypt_batch(packets, self.key)):
+            await self._window.acquire()
+            self._enqueue(packet[:2] + packet[5:7], halves)
+            self.accepted += 1
+
+    async def flush(self):
+        """Waits until every packet taken in so far has been written."""
+        accepted = self.accepted
+        while self.written < accepted:
+            self._progress.clear()
+            await self._progress.wait()
+
+    async def _run(self, link: MeshLink):
+        loop = asyncio.get_running_loop()
+        interval = 1 / self.rate
+        while True:
+            if not link.queue:
+                link.waiter = loop.create_future()
+                await link.waiter
+                continue
+            shard, (low, high) = link.queue[0]
+            # reserve the next slot of the shared budget before waiting for it
+            now = loop.time()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + interval
+            if slot > now:
+                await asyncio.sleep(slot - now)
+            started = loop.time()
+            try:
+                await link.client.write_gatt_char(CHARACTERISTIC_LOW, low, response=link.response)
+                await link.client.write_gatt_char(CHARACTERISTIC_HIGH, high, response=link.response)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                MESH_WRITE_FAILURES.inc()
+                logger.warning(f"mesh: Error writing to {link.mac}, failing over")
+                # the packet we failed on is still at the front of the queue, so it moves along with the rest
+                self.remove(link.mac)
+                if self._on_lost:
+                    self._on_lost(link.mac)
+                return
+            finished = loop.time()
+            link.queue.popleft()
+            self._window.release()
+            MESH_WRITE_SECONDS.observe(finished - started)
+            self.written += 1
+            self._progress.set()
+            if self.throughput is None:
+                self._measure(finished)
+
+    def _measure(self, now: float):
+        pending = self.pending
+        if pending and self.written < MESH_THROUGHPUT_SAMPLE:
+            return
+        self._busy += now - self._busy_since
+        self._busy_since = now if pending else None
+        if self.written < MESH_THROUGHPUT_SAMPLE:
+            return
+        self.throughput = self.written / max(self._busy, 1e-6)
+        logger.info(
+            f"mesh: Measured {self.throughput:.1f} commands/sec over the first {self.written} writes "
+            f"(paced at {self.rate})"
+        )
+
+    def close(self):
+        for mac in list(self._links):
+            self.remove(mac)
+
+
+class MeshPool:
+    """
+    Keeps connections to the `size` strongest mesh nodes, as seen by `scanner`. Every connection feeds the shared
+    notification pipeline (which drops the duplicates that arrive through more than one node) and carries a share of
+    the writes. When a node goes away the remaining ones take over immediately, and the pool tops itself up again in the
+    background. A node that fails to connect is skipped for `MESH_POOL_RETRY_INTERVAL` seconds.
+
+    `on_connected` is awaited whenever the pool goes from no connections to having one.
+    """
+
+    def __init__(
+        self,
+        scanner: MeshScanner,
+        writer: MeshWriter,
+        notifications: NotificationPipeline,
+        targets: Callable[[], List[str]],
+        size: int = MESH_CONNECTIONS,
+        on_connected: Callable[[], Awaitable] = None,
+    ):
+        self._scanner = scanner
+        self._writer = writer
+        self._notifications = notifications
+        self._targets = targets
+        self._size = size
+        self._on_connected = on_connected
+        self._clients: Dict[str, BleakClient] = {}
+        self._failed: Dict[str, float] = {}
+        self._changed = asyncio.Event()
+        self._disconnected_at: Optional[float] = None
+        # disconnects of lost nodes still under way, the loop only keeps weak references to tasks
+        self._disconnecting: Set[asyncio.Task] = set()
+
+    def __len__(self) -> int:
+        return len(self._clients)
+
+    def lost(self, mac: str):
+        """Drops a node, either because it disconnected or because writing to it failed."""
+        client = self._clients.pop(mac, None)
+        if client is None:
+            return
+        logger.warning(f"mesh: Lost {mac}, {len(self._clients)} connections left")
+        self._writer.remove(mac)
+        self._notifications.reassembler.forget(mac)
+        if not self._clients:
+            self._disconnected_at = time.monotonic()
+        if client.is_connected:
+            task = asyncio.create_task(self._disconnect(mac, client))
+            self._disconnecting.add(task)
+            task.add_done_callback(self._disconnecting.discard)
+        self._changed.set()
+
+    async def _disconnect(self, mac: str, client: BleakClient):
+        try:
+            await client.disconnect()
+        except (BleakError, asyncio.TimeoutError, OSError):
+            logger.warning(f"mesh: Error disconnecting from {mac}")
+
+    async def _connect(self, device: BLEDevice) -> bool:
+        mac = device.address.lower()
+        logger.info(f"mesh: connecting to {mac}")
+        client = None
+        try:
+            # connecting straight to the scanned device skips the scan bleak would otherwise do to resolve the address
+            client = BleakClient(device, disconnected_callback=lambda _: self.lost(mac))
+            await client.connect()
+            await client.start_notify(CHARACTERISTIC_LOW, lambda _, data: self._notifications.put(mac, True, data))
+            await client.start_notify(CHARACTERISTIC_HIGH, lambda _, data: self._notifications.put(mac, False, data))
+        except (BleakError, asyncio.TimeoutError, OSError):
+            logger.warning(f"mesh: Error connecting to {mac}")
+            self._failed[mac] = time.monotonic()
+            # connected but unable to subscribe, the connection would otherwise be left open and unused
+            if client is not None and client.is_connected:
+                try:
+                    await client.disconnect()
+                except (BleakError, asyncio.TimeoutError, OSError):
+                    logger.warning(f"mesh: Error disconnecting from {mac}")
+            return False
+
+        logger.info(f"mesh: Connected to {mac}")
+        self._failed.pop(mac, None)
+        first = not self._clients
+        self._clients[mac] = client
+        self._writer.add(mac, client)
+        if first:
+            print("Connected to MQTT and mesh")
+            if self._disconnected_at is not None:
+                elapsed = time.monotonic() - self._disconnected_at
+                print(f"mesh: reconnected in {elapsed:.1f} seconds")
+                BLE_RECONNECTS.inc()
+                BLE_RECONNECT_SECONDS.observe(elapsed)
+                self._disconnected_at = None
+            if self._on_connected:
+                await self._on_connected()
+        return True
+
+    async def _fill(self):
+        now = time.monotonic()
+        for device in self._scanner.candidates(set(self._targets())):
+            if len(self._clients) >= self._size:
+                return
+            mac = device.address.lower()
+            failed_at = self._failed.get(mac)
+            if mac in self._clients or (failed_at is not None and now - failed_at < MESH_POOL_RETRY_INTERVAL):
+                continue
+            await self._connect(device)
+
+    async def run(self):
+        self._scanner.watch(self._changed)
+        try:
+            while True:
+                self._changed.clear()
+                if len(self._clients) < self._size:
+                    await self._fill()
+                if len(self._clients) < self._size:
+                    # not enough nodes, try again as soon as one shows up or we lose one (or in a bit, for the ones
+                    # that failed)
+                    try:
+                        await asyncio.wait_for(self._changed.wait(), MESH_POOL_RETRY_INTERVAL)
+                    except asyncio.TimeoutError:
+                        pass
+                else:
+                    await self._changed.wait()
+        finally:
+            self._scanner.unwatch(self._changed)
+            self._writer.close()
+            for mac, client in list(self._clients.items()):
+                if client.is_connected:
+                    await client.disconnect()
+                    logger.info(f"mesh: Disconnected from {mac}")
+            self._clients.clear()
+            await asyncio.gather(*self._disconnecting, return_exceptions=True)
@@ -0,0 +1,126 @@
+import bisect
+from typing import Dict, List, Tuple
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+REGISTRY = []
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """A monotonically increasing count, optionally split by label values."""
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values: Dict[Tuple, float] = {}
+        REGISTRY.append(self)
+
+    def inc(self, *label_values, amount: float = 1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def get(self, *label_values) -> float:
+        return self._values.get(label_values, 0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for label_values, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+class Gauge:
+    """A value that can go up and down, optionally split by label values."""
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values: Dict[Tuple, float] = {}
+        REGISTRY.append(self)
+
+    def set(self, *label_values, value: float):
+        self._values[label_values] = value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        for label_values, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+class Histogram:
+    """Counts observations into fixed buckets, rendered cumulatively as Prometheus expects."""
+
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+        REGISTRY.append(self)
+
+    def observe(self, value: float):
+        self._counts[bisect.bisect_left(self.buckets, value)] += 1
+        self._sum += value
+        self._count += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for bound, count in zip(self.buckets, self._counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {self._count}')
+        lines.append(f"{self.name}_sum {self._sum}")
+        lines.append(f"{self.name}_count {self._count}")
+        return lines
+
+
+def metrics_render() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+MQTT_COMMANDS = Counter("avionmqtt_mqtt_commands_total", "Light commands received over MQTT", ("avid",))
+MQTT_PUBLISH_SECONDS = Histogram("avionmqtt_mqtt_publish_seconds", "Time taken to publish a state update")
+MESH_WRITE_SECONDS = Histogram("avionmqtt_mesh_write_seconds", "Time taken to write a packet to the mesh")
+MESH_WRITE_FAILURES = Counter("avionmqtt_mesh_write_failures_total", "Packets that failed to be written to the mesh")
+NOTIFICATIONS_DECODED = Counter("avionmqtt_notifications_decoded_total", "Mesh packets decrypted and decoded")
+NOTIFICATIONS_DROPPED = Counter(
+    "avionmqtt_notifications_dropped_total", "Mesh notifications that were not decoded", ("reason",)
+)
+MESH_ROUNDTRIP_SECONDS = Histogram(
+    "avionmqtt_mesh_roundtrip_seconds", "Time from writing a command until the mesh echoed the new state"
+)
+MESH_ROUNDTRIP_LAST = Gauge(
+    "avionmqtt_mesh_roundtrip_last_seconds", "Round trip time of the last confirmed command", ("avid",)
+)
+MESH_RETRIES = Counter("avionmqtt_mesh_retries_total", "Commands written again because they weren't confirmed in time")
+MESH_UNCONFIRMED = Counter(
+    "avionmqtt_mesh_unconfirmed_total", "Commands never confirmed by the mesh, even after retrying", ("avid",)
+)
+MESH_POLLS = Counter("avionmqtt_mesh_polls_total", "State reads sent to individual devices")
+MESH_LAST_SEEN = Gauge(
+    "avionmqtt_mesh_last_seen_timestamp_seconds", "When a device last reported its state (unix time)", ("avid",)
+)
+BLE_RECONNECTS = Counter("avionmqtt_ble_reconnects_total", "Connections made to the mesh after losing one")
+BLE_RECONNECT_SECONDS = Histogram(
+    "avionmqtt_ble_reconnect_seconds", "Time from losing the mesh connection until connected again"
+)
+BLE_SCAN_SECONDS = Histogram(
+    "avionmqtt_ble_scan_seconds", "Time from starting the background scan until the first mesh node was heard"
+)
+SCENE_SECONDS = Histogram(
+    "avionmqtt_scene_seconds", "Time from receiving a scene until all of its packets were written"
+)
@@ -0,0 +1,89 @@
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Hashable, Optional, Tuple
+
+from .metrics import NOTIFICATIONS_DECODED, NOTIFICATIONS_DROPPED
+from .protocol import mesh_decode
+from .reassembly import MeshReassembler
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_NOTIFICATION_DEPTH = 512
+
+
+class NotificationPipeline:
+    """
+    Moves notification handling out of the BLE callback. The callback only appends the raw half to a bounded buffer;
+    `run` reassembles, decrypts and decodes them, and publishes the resulting states. States waiting to be published
+    are conflated per (avid, field), so a slow broker means fewer, newer publishes rather than an ever growing backlog.
+
+    `decrypt` returns the decrypted csrmesh packet, or None if it didn't authenticate.
+    """
+
+    def __init__(
+        self,
+        decrypt: Callable[[bytes], Optional[dict]],
+        publish: Callable[[int, str, int], Awaitable],
+        depth: int = DEFAULT_NOTIFICATION_DEPTH,
+        on_raw: Callable[[Hashable, bool, bytes], None] = None,
+    ):
+        self.reassembler = MeshReassembler()
+        self._decrypt = decrypt
+        self._publish = publish
+        self._on_raw = on_raw
+        self._raw = deque(maxlen=depth)
+        self._pending: OrderedDict[Tuple[int, str], int] = OrderedDict()
+        self._wakeup = asyncio.Event()
+        self.overflowed = 0
+        self.conflated = 0
+
+    def put(self, link: Hashable, is_low: bool, data: bytearray):
+        """
+        Called from the BLE callback, so this must stay cheap and never block. `link` identifies the connection the
+        half arrived through, as halves from different connections must not be paired up.
+        """
+        if len(self._raw) == self._raw.maxlen:
+            self.overflowed += 1
+            NOTIFICATIONS_DROPPED.inc("overflow")
+        # bleak may reuse the buffer, so keep our own copy
+        self._raw.append((link, is_low, bytes(data)))
+        self._wakeup.set()
+
+    def _drain(self):
+        reassembler = self.reassembler
+        while self._raw:
+            link, is_low, data = self._raw.popleft()
+            if self._on_raw:
+                self._on_raw(link, is_low, data)
+            packet = reassembler.feed_low(data, link) if is_low else reassembler.feed_high(data, link)
+            if packet is None:
+                continue
+            try:
+                decoded = self._decrypt(packet)
+                if decoded is None:
+                    reassembler.reject(packet, link)
+                    continue
+                record = mesh_decode(decoded["source"], decoded["decpayload"])
+            except Exception:
+                # whatever a node sends, one bad packet mustn't end the pipeline
+                logger.exception(f"mesh: Unable to decode {packet.hex()}")
+                reassembler.reject(packet, link, "malformed")
+                continue
+            reassembler.accept(packet, link)
+            NOTIFICATIONS_DECODED.inc()
+            if record:
+                avid, field, value = record
+                if (avid, field) in self._pending:
+                    self.conflated += 1
+                self._pending[(avid, field)] = value
+
+    async def run(self):
+        while True:
+            self._drain()
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            (avid, field), value = self._pending.popitem(last=False)
+            await self._publish(avid, field, value)
@@ -0,0 +1,101 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, Iterable, Optional, Set
+
+from .metrics import MESH_LAST_SEEN, MESH_POLLS
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POLL_INTERVAL = 300.0
+DEFAULT_POLL_RATE = 2.0
+
+
+class PollScheduler:
+    """
+    Reads the state of devices one at a time, rather than broadcasting a read that every node answers at once. A device
+    is due once nothing was heard from it for `interval` seconds; due devices are read never-seen first, then stalest
+    first. Reads are paced at `rate` per second, a budget on top of the mesh write rate, and held back entirely while
+    `busy` says commands are waiting, so polling never competes with the user.
+
+    `seen` maps avids to when they last reported their state (monotonic time), and is meant to outlive the scheduler.
+    """
+
+    def __init__(
+        self,
+        read: Callable[[int], Awaitable],
+        avids: Callable[[], Iterable[int]],
+        busy: Callable[[], bool],
+        seen: Dict[int, float],
+        interval: float = DEFAULT_POLL_INTERVAL,
+        rate: float = DEFAULT_POLL_RATE,
+    ):
+        self._read = read
+        self._avids = avids
+        self._busy = busy
+        self.seen = seen
+        self._interval = interval
+        self._rate = rate
+        self._polled: Dict[int, float] = {}
+        self._forced: Set[int] = set()
+        self._wakeup = asyncio.Event()
+
+    def heard(self, avid: int):
+        """Records that `avid` reported its state, whether we asked or not."""
+        self.seen[avid] = time.monotonic()
+        self._forced.discard(avid)
+        MESH_LAST_SEEN.set(avid, value=time.time())
+
+    def poll_unseen(self):
+        """Makes the devices we know nothing about due right away; the others follow their interval."""
+        self._forced = {avid for avid in self._avids() if avid not in self.seen}
+        self._wakeup.set()
+
+    def poll_all(self):
+        """Makes every device due right away, when asked to over MQTT."""
+        self._forced = set(self._avids())
+        self._wakeup.set()
+
+    def _next(self, now: float) -> Optional[int]:
+        best = None
+        best_seen = None
+        for avid in self._avids():
+            seen = self.seen.get(avid, float("-inf"))
+            last = max(seen, self._polled.get(avid, float("-inf")))
+            if avid not in self._forced and now - last < self._interval:
+                continue
+            if best is None or seen < best_seen:
+                best, best_seen = avid, seen
+        return best
+
+    def _due_in(self, now: float) -> float:
+        due_in = self._interval
+        for avid in self._avids():
+            last = max(self.seen.get(avid, float("-inf")), self._polled.get(avid, float("-inf")))
+            due_in = min(due_in, last + self._interval - now)
+        return max(due_in, 0)
+
+    async def _sleep(self, delay: float):
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+
+    async def run(self):
+        interval = 1 / self._rate
+        while True:
+            if self._busy():
+                await asyncio.sleep(interval)
+                continue
+            now = time.monotonic()
+            avid = self._next(now)
+            if avid is None:
+                await self._sleep(self._due_in(now))
+                continue
+            self._forced.discard(avid)
+            self._polled[avid] = now
+            logger.debug(f"mesh: polling {avid}")
+            MESH_POLLS.inc()
+            await self._read(avid)
+            await asyncio.sleep(interval)
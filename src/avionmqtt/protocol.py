@@ -0,0 +1,179 @@
+import logging
+from enum import Enum
+from typing import Dict, Iterable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class Verb(Enum):
+    WRITE = 0
+    READ = 1
+    INSERT = 2
+    TRUNCATE = 3
+    COUNT = 4
+    DELETE = 5
+    PING = 6
+    SYNC = 7
+    OTA = 8
+    PUSH = 11
+    SCAN_WIFI = 12
+    CANCEL_DATASTREAM = 13
+    UPDATE = 16
+    TRIM = 17
+    DISCONNECT_OTA = 18
+    UNREGISTER = 20
+    MARK = 21
+    REBOOT = 22
+    RESTART = 23
+    OPEN_SSH = 32
+    NONE = 255
+
+
+class Noun(Enum):
+    DIMMING = 10
+    FADE_TIME = 25
+    COUNTDOWN = 9
+    DATE = 21
+    TIME = 22
+    SCHEDULE = 7
+    GROUPS = 3
+    SUNRISE_SUNSET = 6
+    ASSOCIATION = 27
+    WAKE_STATUS = 28
+    COLOR = 29
+    CONFIG = 30
+    WIFI_NETWORKS = 31
+    DIMMING_TABLE = 17
+    ASSOCIATED_WIFI_NETWORK = 32
+    ASSOCIATED_WIFI_NETWORK_STATUS = 33
+    SCENES = 34
+    SCHEDULE_2 = 35
+    RAB_IP = 36
+    RAB_ENV = 37
+    RAB_CONFIG = 38
+    THERMOMETER = 39
+    FIRMWARE_VERSION = 40
+    LUX_VALUE = 41
+    TEST_MODE = 42
+    HARCODED_STRING = 43
+    RAB_MARKS = 44
+    MOTION_SENSOR = 45
+    ALS_DIMMING = 46
+    ASSOCIATION_2 = 48
+    RTC_SUN_RISE_SET_TABLE = 71
+    RTC_DATE = 72
+    RTC_TIME = 73
+    RTC_DAYLIGHT_SAVING_TIME_TABLE = 74
+    AVION_SENSOR = 91
+    NONE = 255
+
+
+# the only nouns we turn into state: noun -> (state field, offset of the value, size of the value)
+DECODE_FIELDS = {
+    Noun.DIMMING.value: ("brightness", 1, 1),
+    Noun.COLOR.value: ("color_temp", 2, 2),
+}
+DECODE_VERBS = frozenset(verb.value for verb in Verb)
+DECODE_MAGIC = 0x73
+
+# (avid, state field, value)
+Record = Tuple[int, str, int]
+
+# avids below this address groups
+MESH_FIRST_DEVICE_AVID = 32896
+# the shortest encrypted packet: a sequence number, source, hmac and the end byte around an empty payload
+MESH_PACKET_MIN_SIZE = 14
+
+# what a command carries after its header, by noun: value -> value bytes plus the two trailing zeros
+ENCODE_VALUES = {
+    Noun.DIMMING.value: lambda value: bytes((value, 0, 0, 0, 0)),
+    Noun.COLOR.value: lambda value: bytes((0x01, value >> 8 & 0xFF, value & 0xFF, 0, 0)),
+    # milliseconds
+    Noun.FADE_TIME.value: lambda value: bytes((value >> 8 & 0xFF, value & 0xFF, 0, 0, 0)),
+}
+# the (verb, noun) pairs the bridge sends, templated up front for every avid of the inventory
+ENCODE_TEMPLATES = (
+    (Verb.WRITE.value, Noun.DIMMING.value),
+    (Verb.WRITE.value, Noun.COLOR.value),
+    (Verb.WRITE.value, Noun.FADE_TIME.value),
+    (Verb.READ.value, Noun.DIMMING.value),
+)
+# (avid, verb, noun) -> header
+_headers: Dict[Tuple[int, int, int], bytes] = {}
+
+
+# BLEBridge.decryptMessage
+def mesh_decode(source: int, data: bytes) -> Optional[Record]:
+    """
+    Decodes a decrypted mesh payload into a (avid, field, value) record, or None if it doesn't carry state we track.
+    This runs for every notification, so it indexes straight into the payload instead of slicing or building enums.
+    """
+    n = len(data)
+    if n < 5 or data[2] != DECODE_MAGIC:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("mesh: Unable to handle %s", data.hex())
+        return None
+
+    if data[0] == 0x0 and data[1] == 0x80:
+        target_id = source
+    else:
+        target_id = data[1] << 8 | data[0]
+
+    verb = data[3]
+    noun = data[4]
+    field = DECODE_FIELDS.get(noun)
+    if field is None or verb not in DECODE_VERBS:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("mesh: Ignoring verb %d noun %d from %d", verb, noun, target_id)
+        return None
+
+    if verb == Verb.WRITE.value:
+        # writes carry the group they were addressed to in front of the value
+        if not target_id:
+            if n < 7:
+                return None
+            target_id = data[5] << 8 | data[6]
+        start = 7
+    else:
+        start = 5
+
+    name, offset, size = field
+    i = start + offset
+    if i >= n:
+        value = 0
+    elif size == 1 or i + 1 >= n:
+        value = data[i]
+    else:
+        value = data[i] << 8 | data[i + 1]
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("mesh: Decoded %s=%d for %d from %s", name, value, target_id, data.hex())
+    return target_id, name, value
+
+
+def packet_header(avid: int, verb: int, noun: int) -> bytes:
+    """
+    Returns the first 8 bytes of a packet to `avid`: target (little endian), magic, verb, noun, group (big endian) and
+    id. Headers only depend on their address and command, so each is built once and reused for every packet after.
+    """
+    header = _headers.get((avid, verb, noun))
+    if header is None:
+        if avid < MESH_FIRST_DEVICE_AVID:
+            target, group = 0, avid
+        else:
+            target, group = avid, 0
+        header = bytes((target & 0xFF, target >> 8, DECODE_MAGIC, verb, noun, group >> 8, group & 0xFF, 0))
+        _headers[(avid, verb, noun)] = header
+    return header
+
+
+def packet_templates_prepare(avids: Iterable[int]):
+    """Builds the headers of every command the bridge sends to `avids`, when the inventory is loaded."""
+    for avid in avids:
+        for verb, noun in ENCODE_TEMPLATES:
+            packet_header(avid, verb, noun)
+
+
+def packet_encode(avid: int, noun: Noun, value: int, verb: Verb = Verb.WRITE) -> bytes:
+    """Encodes a DIMMING (brightness), COLOR (kelvin) or FADE_TIME (milliseconds) command, ready to be encrypted."""
+    return packet_header(avid, verb.value, noun.value) + ENCODE_VALUES[noun.value](value)
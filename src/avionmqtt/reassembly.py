@@ -0,0 +1,150 @@
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional
+
+from .metrics import NOTIFICATIONS_DROPPED
+
+logger = logging.getLogger(__name__)
+
+# csrmesh packets start with a 3 byte sequence number and the 2 byte source, both sent in the clear
+HEADER_SIZE = 5
+LOW_SIZE = 20
+
+DEFAULT_DEDUP_WINDOW = 256
+DEFAULT_FRAGMENT_TIMEOUT = 1.0
+
+
+class Fragments:
+    __slots__ = ("low", "low_at", "high", "high_at", "late")
+
+    def __init__(self):
+        self.low: Optional[bytes] = None
+        self.low_at = 0.0
+        self.high: Optional[bytes] = None
+        self.high_at = 0.0
+        # the LOW half just completed with a HIGH half that was waiting for it, until that packet is decrypted
+        self.late: Optional[bytes] = None
+
+
+class MeshReassembler:
+    """
+    Pairs the LOW and HIGH notification halves of a csrmesh packet back together, and drops the copies of a packet
+    that the mesh floods more than once before they get decrypted.
+
+    Halves may arrive in either order; a half that isn't matched within `fragment_timeout` seconds, or that gets
+    replaced by a newer half of the same kind, is counted as orphaned. A HIGH half whose LOW half got lost would pair
+    up with the next LOW half, so when a LOW half completed with an earlier HIGH half doesn't authenticate, the HIGH
+    half is orphaned and the LOW half waits for the HIGH half after it instead. Sequence numbers of the last `dedup_window`
+    accepted packets are remembered to spot duplicates.
+
+    Halves are only ever paired with halves from the same `link` (the mesh node they arrived through), while
+    duplicates are spotted across all of them, as every connected node relays the same packets.
+    """
+
+    def __init__(self, dedup_window: int = DEFAULT_DEDUP_WINDOW, fragment_timeout: float = DEFAULT_FRAGMENT_TIMEOUT):
+        self._dedup_window = dedup_window
+        self._fragment_timeout = fragment_timeout
+        self._links: Dict[Hashable, Fragments] = {}
+        self._seen = OrderedDict()
+        self.packets = 0
+        self.duplicates = 0
+        self.orphaned = 0
+        self.dropped = 0
+
+    def _fresh(self, at: float, now: float) -> bool:
+        return now - at <= self._fragment_timeout
+
+    def _orphan(self):
+        self.orphaned += 1
+        NOTIFICATIONS_DROPPED.inc("orphaned")
+
+    def _complete(self, packet: bytes) -> Optional[bytes]:
+        header = packet[:HEADER_SIZE]
+        if header in self._seen:
+            self._seen.move_to_end(header)
+            self.duplicates += 1
+            NOTIFICATIONS_DROPPED.inc("duplicate")
+            return None
+        return packet
+
+    def _fragments(self, link: Hashable) -> Fragments:
+        fragments = self._links.get(link)
+        if fragments is None:
+            fragments = self._links[link] = Fragments()
+        return fragments
+
+    def forget(self, link: Hashable):
+        """Drops whatever half was still waiting on a link that went away."""
+        fragments = self._links.pop(link, None)
+        if fragments is not None and (fragments.low is not None or fragments.high is not None):
+            self._orphan()
+
+    def feed_low(self, data: bytes, link: Hashable = None) -> Optional[bytes]:
+        """Feeds a LOW half, returning the whole packet if it can be completed and wasn't seen before."""
+        data = bytes(data)
+        if len(data) < LOW_SIZE:
+            # short enough to not need a HIGH half at all
+            return self._complete(data)
+
+        fragments = self._fragments(link)
+        fragments.late = None
+        now = time.monotonic()
+        if fragments.low is not None:
+            self._orphan()
+            fragments.low = None
+        if fragments.high is not None:
+            high = fragments.high
+            fragments.high = None
+            if self._fresh(fragments.high_at, now):
+                fragments.late = data
+                return self._complete(data + high)
+            self._orphan()
+        fragments.low = data
+        fragments.low_at = now
+        return None
+
+    def feed_high(self, data: bytes, link: Hashable = None) -> Optional[bytes]:
+        """Feeds a HIGH half, returning the whole packet if it can be completed and wasn't seen before."""
+        data = bytes(data)
+        fragments = self._fragments(link)
+        fragments.late = None
+        now = time.monotonic()
+        if fragments.high is not None:
+            self._orphan()
+            fragments.high = None
+        if fragments.low is not None:
+            low = fragments.low
+            fragments.low = None
+            if self._fresh(fragments.low_at, now):
+                return self._complete(low + data)
+            self._orphan()
+        # the LOW half might still be on its way
+        fragments.high = data
+        fragments.high_at = now
+        return None
+
+    def accept(self, packet: bytes, link: Hashable = None):
+        """Records a packet that decrypted and authenticated, so later copies of it are dropped as duplicates."""
+        fragments = self._links.get(link)
+        if fragments is not None:
+            fragments.late = None
+        self.packets += 1
+        self._seen[packet[:HEADER_SIZE]] = None
+        if len(self._seen) > self._dedup_window:
+            self._seen.popitem(last=False)
+
+    def reject(self, packet: bytes, link: Hashable = None, reason: str = "unauthenticated"):
+        """Records a packet that didn't authenticate, most likely two halves that didn't belong together."""
+        fragments = self._links.get(link)
+        if fragments is not None and fragments.late is not None:
+            # the HIGH half was the stray one, the LOW half gets another go with the next HIGH half
+            fragments.low = fragments.late
+            fragments.low_at = time.monotonic()
+            fragments.late = None
+            self._orphan()
+            return
+        self.dropped += 1
+        NOTIFICATIONS_DROPPED.inc(reason)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("mesh: Dropping packet %s", packet.hex())
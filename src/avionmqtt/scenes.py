@@ -0,0 +1,87 @@
+import json
+from typing import Dict, FrozenSet, List, Optional, Set, Tuple
+
+# the fields a scene sets, each written as its own packet
+SCENE_FIELDS = ("brightness", "color_temp")
+# non-retained, one message per applied scene
+SCENE_REPORT_TOPIC = "avionmqtt/scene"
+
+# (target avid, field, value, the members a group target stands in for)
+Write = Tuple[int, str, int, Tuple[int, ...]]
+
+
+def scene_parse(raw_payload: str) -> Tuple[str, Optional[str], Dict[int, dict]]:
+    """
+    Parses a scene message, {"scene": name, "location": pid or name, "lights": [{"avid": ..., "brightness": ...,
+    "color_temp": ...}, ...]}, into its name, location (None when not given) and command by avid. A light listed more
+    than once gets its commands merged, the later ones winning. Raises ValueError when the message doesn't make sense.
+
+    A light that is turned on without a brightness keeps "state": "ON" in its command, for `scene_switch_on`.
+    """
+    try:
+        message = json.loads(raw_payload)
+        name = str(message.get("scene", "scene"))
+        location = message.get("location")
+        entries = message["lights"]
+        lights: Dict[int, dict] = {}
+        for entry in entries:
+            avid = int(entry["avid"])
+            command = lights.setdefault(avid, {})
+            # state and brightness are both the brightness, so a later entry with either replaces both
+            if "state" in entry or "brightness" in entry:
+                command.pop("state", None)
+                command.pop("brightness", None)
+            command.update((key, entry[key]) for key in ("state", "brightness", "color_temp") if key in entry)
+        for command in lights.values():
+            # unlike a command from Home Assistant, a scene that says ON means it, color or not
+            state = command.pop("state", None)
+            if "brightness" in command:
+                command["brightness"] = min(max(int(command["brightness"]), 0), 255)
+            elif state == "OFF":
+                command["brightness"] = 0
+            elif state == "ON":
+                command["state"] = "ON"
+            if "color_temp" in command:
+                command["color_temp"] = int(command["color_temp"])
+                if command["color_temp"] <= 0:
+                    raise ValueError(f"color_temp {command['color_temp']}")
+    except (AttributeError, KeyError, TypeError) as e:
+        raise ValueError(f"missing or malformed {e}")
+    return name, None if location is None else str(location), lights
+
+
+def scene_switch_on(lights: Dict[int, dict], brightness: Dict[int, int]):
+    """Turns the lights a scene switches on without a brightness on to their last known `brightness`, or full."""
+    for avid, command in lights.items():
+        if command.pop("state", None) == "ON":
+            command["brightness"] = brightness.get(avid) or 255
+
+
+def scene_plan(lights: Dict[int, dict], groups: Dict[int, FrozenSet[int]], lit: Set[int]) -> List[Write]:
+    """
+    Plans the writes of a scene as a whole. For every field, a group whose members all get the same value is written
+    as one group packet (largest groups first, a light is only ever covered once). The writes are ordered so the room
+    changes as much at once as it can: first what can't be seen (the color of lights that are off and not in `lit`),
+    then everything else, group packets first, as each of those changes many lights in one go.
+    """
+    writes: List[Write] = []
+    for field in SCENE_FIELDS:
+        values = {avid: command[field] for avid, command in lights.items() if field in command}
+        covered: Set[int] = set()
+        for group, members in sorted(groups.items(), key=lambda g: -len(g[1])):
+            if len(members) < 2 or covered & members or not members <= values.keys():
+                continue
+            value = values[next(iter(members))]
+            if all(values[member] == value for member in members):
+                writes.append((group, field, value, tuple(sorted(members))))
+                covered |= members
+        for avid, value in values.items():
+            if avid not in covered:
+                writes.append((avid, field, value, ()))
+
+    def order(write: Write) -> Tuple[int, int]:
+        target, field, _, members = write
+        hidden = field == "color_temp" and not lit & set(members or (target,))
+        return 0 if hidden else 1, -len(members)
+
+    return sorted(writes, key=order)
@@ -0,0 +1,64 @@
+import json
+import logging
+import os
+import time
+from typing import Dict
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FILE = "state.json"
+SNAPSHOT_INTERVAL = 60
+
+
+def snapshot_default_path(settings_file: str) -> str:
+    return os.path.join(os.path.dirname(os.path.abspath(settings_file)), SNAPSHOT_FILE)
+
+
+def snapshot_load(path: str) -> Dict[str, Dict[int, list]]:
+    """
+    Returns the last saved light states by site topic prefix and avid, each as [brightness, color_temp, seen_at] (any
+    of which may be None, seen_at is unix time), or nothing if there is no usable snapshot.
+    """
+    try:
+        with open(path) as stream:
+            saved = json.load(stream)
+        snapshot = {}
+        for prefix, states in saved.items():
+            snapshot[prefix] = {}
+            for avid, (brightness, color_temp, seen_at) in states.items():
+                snapshot[prefix][int(avid)] = [brightness, color_temp, seen_at]
+        return snapshot
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError, AttributeError, TypeError):
+        logger.warning(f"state: Ignoring unreadable snapshot {path}")
+        return {}
+
+
+def snapshot_dumps(sites: Dict[str, Dict[int, list]]) -> str:
+    # compact, as it's rewritten every so often
+    return json.dumps(
+        {prefix: {str(avid): state for avid, state in states.items()} for prefix, states in sites.items()},
+        separators=(",", ":"),
+    )
+
+
+def snapshot_save(path: str, data: str):
+    # never leave a half written file behind, a torn snapshot would be worse than none
+    temp_path = path + ".tmp"
+    try:
+        with open(temp_path, "w") as stream:
+            stream.write(data)
+        os.replace(temp_path, path)
+    except OSError:
+        logger.warning(f"state: Unable to write snapshot {path}")
+
+
+def snapshot_time(monotonic: float) -> float:
+    """Converts a monotonic timestamp to unix time, for storing."""
+    return time.time() - (time.monotonic() - monotonic)
+
+
+def snapshot_monotonic(unix: float) -> float:
+    """Converts a stored unix timestamp back to monotonic time."""
+    return time.monotonic() - (time.time() - unix)
@@ -0,0 +1,43 @@
+import time
+from typing import List, Optional, Tuple
+
+
+class StartupProfile:
+    """
+    Records how long each phase of startup takes, from the moment the package starts importing until the mesh is
+    connected. Phases that run one after another are timed from the previous one; those running alongside them (like
+    the web UI) pass when they started. Only the first time a phase is reached counts, reconnects aren't startup.
+
+    Once enabled every phase is printed as it completes, see --profile-startup.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self._last = self.started
+        # (phase, seconds it took, seconds since import when it completed)
+        self.phases: List[Tuple[str, float, float]] = []
+        self.enabled = False
+
+    def mark(self, phase: str, started: Optional[float] = None):
+        if any(name == phase for name, _, _ in self.phases):
+            return
+        now = time.perf_counter()
+        if started is None:
+            started, self._last = self._last, now
+        self.phases.append((phase, now - started, now - self.started))
+        if self.enabled:
+            self._print(*self.phases[-1])
+
+    def enable(self):
+        """Prints the phases completed so far, and every phase after."""
+        self.enabled = True
+        for phase in self.phases:
+            self._print(*phase)
+
+    @staticmethod
+    def _print(phase: str, elapsed: float, total: float):
+        print(f"startup: {phase} took {elapsed:.3f}s, {total:.3f}s since import")
+
+
+# created before anything else of the package is imported, so the first phase covers all imports
+STARTUP = StartupProfile()
@@ -0,0 +1,108 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Iterable, Optional, Tuple
+
+import aiomqtt
+
+from .metrics import MQTT_PUBLISH_SECONDS
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MIN_INTERVAL = 0.1
+
+STATE_TOPIC = "hmd/light/avid/{avid}/state"
+
+# rendering the few payload shapes we publish by hand is far cheaper than json.dumps on every notification
+TEMPLATE_FULL = '{"state": "%s", "brightness": %d, "color_temp": %d}'
+TEMPLATE_DIMMING = '{"state": "%s", "brightness": %d}'
+TEMPLATE_COLOR_TEMP = '{"color_temp": %d}'
+
+
+def state_render(state: dict) -> Optional[str]:
+    brightness = state.get("brightness")
+    color_temp = state.get("color_temp")
+    if brightness is None:
+        return None if color_temp is None else TEMPLATE_COLOR_TEMP % color_temp
+    on_off = "ON" if brightness != 0 else "OFF"
+    if color_temp is None:
+        return TEMPLATE_DIMMING % (on_off, brightness)
+    return TEMPLATE_FULL % (on_off, brightness, color_temp)
+
+
+class StateStore:
+    """
+    The authoritative brightness and color temperature of every avid. Partial updates from the mesh are merged into a
+    full state document, which is only published when it actually changed, and at most once per `min_interval`
+    seconds per avid (later changes within the interval are folded into a single deferred publish).
+
+    States are published to `topic`, formatted with the avid.
+    """
+
+    def __init__(self, mqtt: aiomqtt.Client, min_interval: float = DEFAULT_MIN_INTERVAL, topic: str = STATE_TOPIC):
+        self._mqtt = mqtt
+        self._min_interval = min_interval
+        self._topic_format = topic
+        self._states: Dict[int, dict] = {}
+        self._topics: Dict[int, str] = {}
+        self._published: Dict[int, str] = {}
+        self._published_at: Dict[int, float] = {}
+        self._deferred: Dict[int, asyncio.Task] = {}
+
+    def get(self, avid: int) -> Optional[dict]:
+        return self._states.get(avid)
+
+    def items(self) -> Iterable[Tuple[int, dict]]:
+        return self._states.items()
+
+    def seed(self, avid: int, state: dict):
+        """Restores a state known from before a restart, without publishing it (see `republish`)."""
+        self._states[avid] = {field: value for field, value in state.items() if value is not None}
+
+    async def republish(self):
+        """Publishes every known state, e.g. on a new connection to a broker that may have lost its retained ones."""
+        self._published.clear()
+        await asyncio.gather(*(self._publish(avid) for avid in list(self._states) if avid not in self._deferred))
+
+    def _topic(self, avid: int) -> str:
+        topic = self._topics.get(avid)
+        if topic is None:
+            topic = self._topics[avid] = self._topic_format.format(avid=avid)
+        return topic
+
+    async def update(self, avid: int, field: str, value: int) -> bool:
+        """Merges a decoded mesh record into the store, returning whether anything changed."""
+        state = self._states.get(avid)
+        if state is None:
+            state = self._states[avid] = {}
+        if state.get(field) == value:
+            return False
+        state[field] = value
+
+        if avid in self._deferred:
+            # a publish is already scheduled and will pick up this change
+            return True
+        remaining = self._published_at.get(avid, 0) + self._min_interval - time.monotonic()
+        if remaining > 0:
+            self._deferred[avid] = asyncio.create_task(self._publish_later(avid, remaining))
+        else:
+            await self._publish(avid)
+        return True
+
+    async def _publish_later(self, avid: int, delay: float):
+        try:
+            await asyncio.sleep(delay)
+            del self._deferred[avid]
+            await self._publish(avid)
+        except aiomqtt.MqttError:
+            logger.warning(f"mqtt: Unable to publish deferred state for {avid}")
+
+    async def _publish(self, avid: int):
+        payload = state_render(self._states[avid])
+        if payload is None or payload == self._published.get(avid):
+            return
+        logger.info(f"mqtt: sending update for {avid}: {payload}")
+        self._published[avid] = payload
+        self._published_at[avid] = started = time.monotonic()
+        await self._mqtt.publish(self._topic(avid), payload, retain=True)
+        MQTT_PUBLISH_SECONDS.observe(time.monotonic() - started)
@@ -0,0 +1,90 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, Iterable, Optional, Tuple
+
+from .metrics import MESH_RETRIES, MESH_ROUNDTRIP_LAST, MESH_ROUNDTRIP_SECONDS, MESH_UNCONFIRMED
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONFIRM_DEADLINE = 2.0
+DEFAULT_CONFIRM_RETRIES = 2
+
+
+class Expectation:
+    __slots__ = ("value", "packet", "first_sent_at", "sent_at", "attempts")
+
+    def __init__(self, value: int, packet: bytes, now: float):
+        self.value = value
+        self.packet = packet
+        self.first_sent_at = now
+        self.sent_at = now
+        self.attempts = 1
+
+
+class CommandTracker:
+    """
+    Correlates the commands written to the mesh with the state the lights echo back. Confirmed commands record their
+    round trip time; commands that aren't confirmed within `deadline` seconds are written again, up to `retries` times.
+
+    Unless `optimistic` is set, callers are expected to only publish state once the echo arrives.
+    """
+
+    def __init__(
+        self,
+        resend: Callable[[bytes], Awaitable],
+        deadline: float = DEFAULT_CONFIRM_DEADLINE,
+        retries: int = DEFAULT_CONFIRM_RETRIES,
+        optimistic: bool = True,
+    ):
+        self._resend = resend
+        self._deadline = deadline
+        self._retries = retries
+        self.optimistic = optimistic
+        self._pending: Dict[Tuple[int, str], Expectation] = {}
+        self.roundtrip: Dict[int, float] = {}
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def expect(self, avids: Iterable[int], field: str, value: int, packet: bytes):
+        """Registers that `packet` should make each of `avids` report `field` as `value`."""
+        now = time.monotonic()
+        for avid in avids:
+            # a newer command for the same light and field supersedes whatever we were still waiting for
+            self._pending[(avid, field)] = Expectation(value, packet, now)
+
+    def confirm(self, avid: int, field: str, value: int) -> Optional[float]:
+        """Matches a state reported by the mesh against what we sent, returning the round trip time on a match."""
+        expectation = self._pending.get((avid, field))
+        if expectation is None or expectation.value != value:
+            return None
+        del self._pending[(avid, field)]
+        roundtrip = time.monotonic() - expectation.first_sent_at
+        self.roundtrip[avid] = roundtrip
+        MESH_ROUNDTRIP_SECONDS.observe(roundtrip)
+        MESH_ROUNDTRIP_LAST.set(avid, value=roundtrip)
+        logger.debug(f"mesh: {field} for {avid} confirmed after {roundtrip * 1000:.0f}ms")
+        return roundtrip
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self._deadline / 2)
+            now = time.monotonic()
+            resent = set()
+            for (avid, field), expectation in list(self._pending.items()):
+                if now - expectation.sent_at < self._deadline:
+                    continue
+                if expectation.attempts > self._retries:
+                    logger.warning(f"mesh: {field} for {avid} never confirmed, giving up")
+                    MESH_UNCONFIRMED.inc(avid)
+                    del self._pending[(avid, field)]
+                    continue
+                expectation.attempts += 1
+                expectation.sent_at = now
+                # a group packet covers several expectations, but only needs writing once
+                if expectation.packet not in resent:
+                    resent.add(expectation.packet)
+                    logger.info(f"mesh: {field} for {avid} not confirmed, retrying")
+                    MESH_RETRIES.inc()
+                    await self._resend(expectation.packet)
@@ -0,0 +1,96 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, FrozenSet, Iterable, Tuple
+
+from .commands import PRIORITY_BACKGROUND, PRIORITY_DIMMING, CommandScheduler
+
+logger = logging.getLogger(__name__)
+
+# the share of the mesh write rate that fades take between them, the rest is left to commands
+FADE_SHARE = 0.5
+# steps per second beyond which a fade doesn't look any smoother
+FADE_MAX_STEP_RATE = 10
+# the longest fade time a light can be given, in milliseconds
+FADE_TIME_MAX = 0xFFFF
+
+
+class FadeScheduler:
+    """
+    Fades lights that can't fade by themselves, by stepping their brightness from where it is to where it should be.
+    Between them, running fades take at most `share` of the mesh write `rate`: the more lights fade at once, the
+    coarser their steps, but every fade still ends on time.
+
+    Steps go through `commands` at background priority, keyed by light, so commands always go first and a step that
+    couldn't be written before the next one is simply replaced by it. `step` writes an intermediate brightness, without
+    publishing or confirming it; `finish` sends the command the fade ends in.
+    """
+
+    def __init__(
+        self,
+        commands: CommandScheduler,
+        step: Callable[[int, int], Awaitable],
+        finish: Callable[[int, dict, Tuple[int, ...]], Awaitable],
+        rate: float,
+        share: float = FADE_SHARE,
+    ):
+        self._commands = commands
+        self._step = step
+        self._finish = finish
+        self._budget = rate * share
+        self._fades: Dict[int, asyncio.Task] = {}
+        # the lights each fade changes: the group and its members, or just the one light
+        self._lights: Dict[int, FrozenSet[int]] = {}
+
+    def __len__(self) -> int:
+        return len(self._fades)
+
+    def start(
+        self, avid: int, members: Tuple[int, ...], lights: FrozenSet[int], start: int, payload: dict, duration: float
+    ):
+        """Fades `avid`, which changes `lights`, from `start` to the brightness of `payload` over `duration` seconds."""
+        self.cancel(lights)
+        self._lights[avid] = lights
+        self._fades[avid] = asyncio.create_task(self._run(avid, members, start, payload, duration))
+
+    def cancel(self, lights: Iterable[int]):
+        """
+        Stops the fades that change any of `lights` where they are, when a newer command for them comes along. A
+        command for one light of a group stops the fade of that group, and one for the group those of its lights.
+        """
+        lights = frozenset(lights)
+        for avid, faded in list(self._lights.items()):
+            if faded & lights:
+                self._stop(avid)
+
+    def close(self):
+        for avid in list(self._lights):
+            self._stop(avid)
+
+    def _stop(self, avid: int):
+        del self._lights[avid]
+        task = self._fades.pop(avid, None)
+        if task is not None:
+            task.cancel()
+        # the end of a fade may still be queued after its task is done
+        self._commands.cancel(("fade", avid))
+
+    async def _run(self, avid: int, members: Tuple[int, ...], start: int, payload: dict, duration: float):
+        loop = asyncio.get_running_loop()
+        target = payload["brightness"]
+        started = loop.time()
+        steps = 0
+        try:
+            while True:
+                elapsed = loop.time() - started
+                if elapsed >= duration:
+                    break
+                value = round(start + (target - start) * elapsed / duration)
+                self._commands.submit(("fade", avid), PRIORITY_BACKGROUND, lambda value=value: self._step(avid, value))
+                steps += 1
+                await asyncio.sleep(max(1 / FADE_MAX_STEP_RATE, len(self._fades) / self._budget))
+            # the end of the fade is the command that was asked for, so it isn't held back like the steps
+            self._commands.submit(("fade", avid), PRIORITY_DIMMING, lambda: self._finish(avid, payload, members))
+            logger.debug(f"fade: {avid} from {start} to {target} in {steps} steps")
+        finally:
+            if self._fades.get(avid) is asyncio.current_task():
+                del self._fades[avid]
@@ -1,10 +1,10 @@
-from flask import Flask, Response
-from threading import Lock
+from aiohttp import web
 
-app = Flask(__name__)
-LOG_BUFFER = []
-LOG_LOCK = Lock()
-device_list = []
+from .logbuffer import LOG_BUFFER
+from .metrics import metrics_render
+
+WEB_HOST = "0.0.0.0"
+WEB_PORT = 5000
 
 LOG_HTML = """
 <html>
@@ -21,6 +21,10 @@ span.critical { color: red; font-weight: bold; }
 .controls { margin-bottom: 10px; }
 </style>
 <script>
+const MAX_LINES = 500;
+let cursor = 0;
+let lines = [];
+
 function togglePause() {
     let paused = document.getElementById('pauseButton').dataset.paused === 'true';
     document.getElementById('pauseButton').dataset.paused = (!paused).toString();
@@ -29,12 +33,18 @@ function togglePause() {
 
 function refreshLogs() {
     if (document.getElementById('pauseButton').dataset.paused === 'true') return;
-    fetch('/logs')
-        .then(response => response.text())
-        .then(data => document.getElementById('logContainer').innerHTML = data);
+    fetch('/logs?since=' + cursor)
+        .then(response => response.json())
+        .then(data => {
+            cursor = data.cursor;
+            if (data.lines.length === 0 && lines.length !== 0) return;
+            lines = lines.concat(data.lines).slice(-MAX_LINES);
+            document.getElementById('logContainer').textContent = lines.join('\\n');
+        });
 }
 
 setInterval(refreshLogs, 2000);
+refreshLogs();
 </script>
 </head>
 <body>
@@ -46,15 +56,47 @@ setInterval(refreshLogs, 2000);
 </html>
 """
 
-@app.route('/')
-def index():
-    return LOG_HTML
+routes = web.RouteTableDef()
+
+
+@routes.get("/")
+async def index(request: web.Request) -> web.Response:
+    return web.Response(text=LOG_HTML, content_type="text/html")
+
+
+@routes.get("/logs")
+async def logs(request: web.Request) -> web.Response:
+    since = request.query.get("since")
+    if since is None:
+        lines, _ = LOG_BUFFER.since(0)
+        return web.Response(text="\n".join(lines), content_type="text/plain")
+    try:
+        cursor = int(since)
+    except ValueError:
+        raise web.HTTPBadRequest(text="since must be an integer")
+    lines, cursor = LOG_BUFFER.since(cursor)
+    return web.json_response({"cursor": cursor, "lines": lines})
+
+
+@routes.get("/metrics")
+async def metrics(request: web.Request) -> web.Response:
+    return web.Response(text=metrics_render(), content_type="text/plain", charset="utf-8")
+
+
+@routes.get("/devices")
+async def devices(request: web.Request) -> web.Response:
+    return web.json_response(request.app["devices"])
 
-@app.route('/logs')
-def logs():
-    with LOG_LOCK:
-        content = "\n".join(LOG_BUFFER[-500:])
-    return Response(content, mimetype='text/plain')
 
-def start_webserver():
-    app.run(host="0.0.0.0", port=5000)
+async def start_webserver(devices: list, host: str = WEB_HOST, port: int = WEB_PORT) -> web.AppRunner:
+    """
+    Serves the web UI from the running event loop; the returned runner is used to shut it down again. `devices` is
+    listed at /devices as it is at the time of the request.
+    """
+    app = web.Application()
+    app["devices"] = devices
+    app.add_routes(routes)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
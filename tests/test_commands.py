@@ -0,0 +1,299 @@
+import asyncio
+
+import pytest
+
+from avionmqtt.commands import (
+    OVERFLOW_DROP_NEWEST,
+    OVERFLOW_DROP_OLDEST,
+    PRIORITY_BACKGROUND,
+    PRIORITY_COLOR_TEMP,
+    PRIORITY_DIMMING,
+    PRIORITY_SWITCH,
+    CommandScheduler,
+    command_brightness,
+    command_merge,
+    command_priority,
+    command_validate,
+)
+
+
+class Sent(list):
+    """Records what a scheduler sends, as (avid, command, members)."""
+
+    async def __call__(self, avid: int, command: dict, members: tuple):
+        self.append((avid, command, members))
+
+
+async def dispatch(scheduler: CommandScheduler, settle: float = 0):
+    """Runs `scheduler` until everything submitted so far went out."""
+    task = asyncio.create_task(scheduler.run())
+    await asyncio.sleep(settle)
+    for _ in range(1000):
+        if not len(scheduler):
+            break
+        await asyncio.sleep(0.001)
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+
+
+@pytest.mark.parametrize(
+    "payload, brightness",
+    [
+        ({"brightness": 40}, 40),
+        ({"state": "ON", "brightness": 40}, 40),
+        ({"state": "ON"}, 255),
+        ({"state": "OFF"}, 0),
+        ({"state": "OFF", "color_temp": 300}, 0),
+        # Home Assistant sends the state along with a color change, which doesn't turn the light up
+        ({"state": "ON", "color_temp": 300}, None),
+        ({"color_temp": 300}, None),
+    ],
+)
+def test_command_brightness(payload, brightness):
+    assert command_brightness(payload) == brightness
+
+
+@pytest.mark.parametrize(
+    "pending, payload, merged",
+    [
+        # state and brightness are one write, the newest of either wins
+        ({"brightness": 20}, {"state": "OFF"}, {"state": "OFF"}),
+        ({"state": "OFF"}, {"brightness": 30}, {"brightness": 30}),
+        # other fields are kept
+        ({"color_temp": 200}, {"brightness": 30}, {"color_temp": 200, "brightness": 30}),
+        ({"brightness": 30}, {"color_temp": 250}, {"brightness": 30, "color_temp": 250}),
+        # a turn on isn't lost to a color change that came after it
+        ({"state": "ON"}, {"state": "ON", "color_temp": 300}, {"state": "ON", "brightness": 255, "color_temp": 300}),
+        ({"brightness": 10}, {"state": "ON", "color_temp": 300}, {"brightness": 10, "state": "ON", "color_temp": 300}),
+        # a transition only applies to the command it came with
+        ({"brightness": 10, "transition": 2}, {"color_temp": 300}, {"brightness": 10, "color_temp": 300}),
+        ({"brightness": 10}, {"brightness": 20, "transition": 2}, {"brightness": 20, "transition": 2}),
+    ],
+)
+def test_command_merge(pending, payload, merged):
+    assert command_merge(pending, payload) == merged
+
+
+@pytest.mark.parametrize(
+    "payload, priority",
+    [
+        # shaped like what Home Assistant sends, which includes the state with every change
+        ({"state": "ON"}, PRIORITY_SWITCH),
+        ({"state": "OFF"}, PRIORITY_SWITCH),
+        ({"state": "OFF", "transition": 2}, PRIORITY_SWITCH),
+        ({"state": "ON", "brightness": 10}, PRIORITY_DIMMING),
+        ({"state": "ON", "brightness": 10, "transition": 2}, PRIORITY_DIMMING),
+        ({"state": "ON", "color_temp": 300}, PRIORITY_COLOR_TEMP),
+        # a pending turn on merged with a color change is still a turn on
+        (command_merge({"state": "ON"}, {"state": "ON", "color_temp": 300}), PRIORITY_SWITCH),
+        ({"brightness": 10}, PRIORITY_DIMMING),
+        ({"color_temp": 300}, PRIORITY_COLOR_TEMP),
+    ],
+)
+def test_command_priority(payload, priority):
+    assert command_priority(payload) == priority
+
+
+def test_command_validate():
+    payload = {"state": "ON", "brightness": 99.6, "color_temp": 300, "transition": 1.5, "effect": "none"}
+    assert command_validate(payload) == {"state": "ON", "brightness": 100, "color_temp": 300, "transition": 1.5}
+
+
+@pytest.mark.parametrize(
+    "payload",
+    [
+        [],
+        {"state": "DIM"},
+        {"brightness": "10"},
+        {"brightness": -1},
+        {"brightness": 256},
+        {"brightness": True},
+        {"color_temp": 0},
+        {"color_temp": None},
+        {"transition": -2},
+    ],
+)
+def test_command_validate_rejects_what_doesnt_make_sense(payload):
+    with pytest.raises(ValueError):
+        command_validate(payload)
+
+
+def test_commands_for_the_same_light_are_coalesced():
+    async def run():
+        sent = Sent()
+        scheduler = CommandScheduler(sent)
+        scheduler.submit_command(32897, {"brightness": 10})
+        scheduler.submit_command(32897, {"brightness": 20})
+        scheduler.submit_command(32897, {"color_temp": 300})
+        assert len(scheduler) == 1
+        await dispatch(scheduler)
+        return sent
+
+    assert asyncio.run(run()) == [(32897, {"brightness": 20, "color_temp": 300}, ())]
+
+
+def test_dispatches_by_priority():
+    async def run():
+        sent = Sent()
+        scheduler = CommandScheduler(sent)
+        scheduler.submit("poll", PRIORITY_BACKGROUND, lambda: sent(0, {"poll": True}, ()))
+        scheduler.submit_command(1, {"state": "ON", "color_temp": 300})
+        scheduler.submit_command(2, {"state": "ON", "brightness": 10})
+        scheduler.submit_command(3, {"state": "OFF"})
+        scheduler.submit_command(4, {"state": "ON", "brightness": 20})
+        await dispatch(scheduler)
+        return [avid for avid, _, _ in sent]
+
+    # by priority, and in order of arrival within one
+    assert asyncio.run(run()) == [3, 2, 4, 1, 0]
+
+
+def test_a_command_moving_up_in_priority_takes_its_new_place():
+    async def run():
+        sent = Sent()
+        scheduler = CommandScheduler(sent)
+        scheduler.submit_command(1, {"color_temp": 300})
+        scheduler.submit_command(2, {"color_temp": 300})
+        scheduler.submit_command(2, {"state": "OFF"})
+        await dispatch(scheduler)
+        return [avid for avid, _, _ in sent]
+
+    assert asyncio.run(run()) == [2, 1]
+
+
+def test_overflow_drop_oldest():
+    async def run():
+        sent = Sent()
+        scheduler = CommandScheduler(sent, depth=2, overflow=OVERFLOW_DROP_OLDEST)
+        assert scheduler.submit_command(1, {"color_temp": 300})
+        assert scheduler.submit_command(2, {"color_temp": 300})
+        # room is made at the least important level first
+        assert scheduler.submit_command(3, {"state": "ON"})
+        assert scheduler.submit_command(4, {"state": "ON"})
+        # but never for something less important
+        assert not scheduler.submit_command(5, {"color_temp": 300})
+        assert scheduler.dropped == 3
+        await dispatch(scheduler)
+        return [avid for avid, _, _ in sent]
+
+    assert asyncio.run(run()) == [3, 4]
+
+
+def test_overflow_drop_newest():
+    async def run():
+        sent = Sent()
+        scheduler = CommandScheduler(sent, depth=2, overflow=OVERFLOW_DROP_NEWEST)
+        assert scheduler.submit_command(1, {"color_temp": 300})
+        assert scheduler.submit_command(2, {"color_temp": 300})
+        assert not scheduler.submit_command(3, {"state": "ON"})
+        # updating what is already queued still works
+        assert scheduler.submit_command(2, {"color_temp": 250})
+        assert scheduler.dropped == 1
+        await dispatch(scheduler)
+        return sent
+
+    assert asyncio.run(run()) == [(1, {"color_temp": 300}, ()), (2, {"color_temp": 250}, ())]
+
+
+def test_failing_entry_doesnt_stop_the_rest():
+    async def run():
+        sent = Sent()
+
+        async def send(avid: int, command: dict, members: tuple):
+            if avid == 1:
+                raise ZeroDivisionError()
+            await sent(avid, command, members)
+
+        async def job():
+            raise TypeError()
+
+        scheduler = CommandScheduler(send)
+        scheduler.submit("job", PRIORITY_SWITCH, job)
+        scheduler.submit_command(1, {"color_temp": 300})
+        scheduler.submit_command(2, {"color_temp": 300})
+        await dispatch(scheduler)
+        return sent
+
+    assert asyncio.run(run()) == [(2, {"color_temp": 300}, ())]
+
+
+def test_unknown_overflow_policy():
+    with pytest.raises(ValueError):
+        CommandScheduler(Sent(), overflow="drop_everything")
+
+
+def test_cancel_drops_what_is_pending():
+    async def run():
+        sent = Sent()
+        scheduler = CommandScheduler(sent)
+        scheduler.submit_command(1, {"brightness": 10})
+        scheduler.submit_command(2, {"brightness": 10})
+        assert scheduler.cancel(1)
+        assert not scheduler.cancel(1)
+        await dispatch(scheduler)
+        return [avid for avid, _, _ in sent]
+
+    assert asyncio.run(run()) == [2]
+
+
+GROUPS = {1: frozenset({10, 11, 12}), 2: frozenset({12, 13})}
+
+
+def test_same_command_for_a_whole_group_is_collapsed():
+    async def run():
+        sent = Sent()
+        scheduler = CommandScheduler(sent, groups=GROUPS, group_window=1)
+        for avid in (10, 11, 12):
+            scheduler.submit_command(avid, {"brightness": 50})
+        await dispatch(scheduler)
+        return sent, scheduler.collapsed
+
+    sent, collapsed = asyncio.run(run())
+    assert sent == [(1, {"brightness": 50}, (10, 11, 12))]
+    assert collapsed == 2
+
+
+def test_lone_group_member_isnt_held():
+    async def run():
+        sent = Sent()
+        scheduler = CommandScheduler(sent, groups=GROUPS, group_window=10)
+        scheduler.submit_command(10, {"brightness": 50})
+        await asyncio.wait_for(dispatch(scheduler), 1)
+        return sent
+
+    assert asyncio.run(run()) == [(10, {"brightness": 50}, ())]
+
+
+def test_held_group_doesnt_hold_up_other_lights():
+    async def run():
+        sent = Sent()
+        scheduler = CommandScheduler(sent, groups=GROUPS, group_window=0.2)
+        scheduler.submit_command(10, {"state": "ON"})
+        scheduler.submit_command(11, {"state": "ON"})
+        scheduler.submit_command(12, {"state": "OFF"})
+        scheduler.submit_command(99, {"brightness": 5})
+        task = asyncio.create_task(scheduler.run())
+        await asyncio.sleep(0.05)
+        early = list(sent)
+        # updating the pending command of the last member in place completes the group well before the window ends
+        scheduler.submit_command(12, {"state": "ON"})
+        await asyncio.sleep(0.05)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return early, sent
+
+    early, sent = asyncio.run(run())
+    assert early == [(99, {"brightness": 5}, ())]
+    assert sent[1:] == [(1, {"state": "ON"}, (10, 11, 12))]
+
+
+def test_held_group_goes_out_member_by_member_after_the_window():
+    async def run():
+        sent = Sent()
+        scheduler = CommandScheduler(sent, groups=GROUPS, group_window=0.05)
+        scheduler.submit_command(10, {"brightness": 50})
+        scheduler.submit_command(11, {"brightness": 50})
+        await dispatch(scheduler, settle=0.1)
+        return sent
+
+    assert asyncio.run(run()) == [(10, {"brightness": 50}, ()), (11, {"brightness": 50}, ())]
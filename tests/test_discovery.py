@@ -0,0 +1,36 @@
+import json
+
+from avionmqtt import location_topic_prefix
+from avionmqtt.discovery import discovery_messages
+
+SETTINGS = {"groups": {"import": True}, "devices": {"import": True}, "all": {"name": "All"}}
+
+
+def location(pid: str) -> dict:
+    device = {"pid": f"{pid}-desk", "product_id": 134, "avid": 32897, "name": "Desk"}
+    return {"pid": pid, "name": pid, "passphrase": pid, "devices": [device], "groups": []}
+
+
+def configs(messages: dict) -> dict:
+    return {topic: json.loads(payload) for topic, payload in messages.items() if topic.startswith("homeassistant/")}
+
+
+def test_single_location_keeps_its_ids():
+    home = location("home")
+    messages = configs(discovery_messages(SETTINGS, home, location_topic_prefix(home, 0, 1)))
+    assert messages["homeassistant/light/desk/config"]["unique_id"] == "home-desk"
+    assert messages["homeassistant/light/all/config"]["unique_id"] == "avion_all"
+
+
+def test_locations_dont_share_topics_or_ids():
+    locations = [location("home"), location("cabin")]
+    topics, unique_ids = set(), set()
+    for index, each in enumerate(locations):
+        messages = configs(discovery_messages(SETTINGS, each, location_topic_prefix(each, index, len(locations))))
+        assert not topics & messages.keys()
+        topics |= messages.keys()
+        ids = {config["unique_id"] for config in messages.values()}
+        assert not unique_ids & ids
+        unique_ids |= ids
+    assert "homeassistant/light/cabin_desk/config" in topics
+    assert "homeassistant/light/home_all/config" in topics
@@ -0,0 +1,237 @@
+import asyncio
+import copy
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from avionhttp import HTTP_CONCURRENCY, http_list_devices
+from avionmqtt import Site, inventory_get, inventory_refresh, mesh_key
+from avionmqtt.discovery import MQTT_TOPIC_PREFIX, DiscoveryPublisher
+from avionmqtt.inventory import INVENTORY_TTL, inventory_load
+from avionmqtt.state import StateStore
+
+DEVICES = [
+    {"pid": "d1", "product_id": 134, "avid": 32897, "name": "Desk", "friendly_mac_address": "AABBCCDDEE01"},
+    {"pid": "d2", "product_id": 134, "avid": 32898, "name": "Hall", "friendly_mac_address": "AABBCCDDEE02"},
+]
+GROUPS = [{"pid": "g1", "avid": 1, "name": "Office", "devices": ["d1", "d2"]}]
+
+
+class AvionApi(BaseHTTPRequestHandler):
+    """Answers the requests avionhttp makes, from the inventory of the server it is part of."""
+
+    def do_POST(self):
+        self.server.requests += 1
+        self.reply({"credentials": {"auth_token": "token"}})
+
+    def do_GET(self):
+        self.server.requests += 1
+        time.sleep(self.server.delay)
+        inventory = self.server.inventory
+        path = self.path.strip("/")
+        if path == "user/locations":
+            self.reply({"locations": [{"pid": 1}]})
+        elif path == "locations/1":
+            self.reply({"location": {"name": "Home", "passphrase": inventory["passphrase"]}})
+        elif path == "locations/1/abstract_devices":
+            self.reply({"abstract_devices": [{"type": "device", **device} for device in inventory["devices"]]})
+        elif path == "locations/1/groups":
+            groups = [{key: group[key] for key in ("pid", "avid", "name")} for group in inventory["groups"]]
+            self.reply({"groups": groups})
+        elif path.startswith("groups/"):
+            group = next(group for group in inventory["groups"] if group["pid"] == path.split("/")[1])
+            self.reply({"group": {"devices": group["devices"]}})
+        else:
+            self.send_error(404)
+
+    def reply(self, body: dict):
+        payload = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+class Recorder:
+    """Stands in for the mqtt client, keeping what was published."""
+
+    def __init__(self):
+        self.published = {}
+
+    async def publish(self, topic: str, payload: str, retain: bool = False):
+        self.published[topic] = payload
+
+
+@pytest.fixture
+def api():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), AvionApi)
+    server.requests = 0
+    server.delay = 0
+    server.inventory = {"passphrase": "secret", "devices": copy.deepcopy(DEVICES), "groups": copy.deepcopy(GROUPS)}
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def settings_for(api) -> dict:
+    host = f"http://127.0.0.1:{api.server_address[1]}/"
+    return {
+        "avion": {"email": "user@example.com", "password": "password", "host": host},
+        "groups": {"import": True},
+        "devices": {"import": True},
+    }
+
+
+def site_for(location: dict, settings: dict) -> Site:
+    states = StateStore(Recorder(), 0, f"{MQTT_TOPIC_PREFIX}/{{avid}}/state")
+    return Site(location, MQTT_TOPIC_PREFIX, states, settings)
+
+
+def cache_write(path, locations, age: float):
+    with open(path, "w") as stream:
+        json.dump({"fetched_at": time.time() - age, "locations": locations}, stream)
+
+
+def test_cold_start_fetches_and_caches(api, tmp_path):
+    settings = settings_for(api)
+    cache_path = str(tmp_path / "inventory.json")
+
+    locations, age = asyncio.run(inventory_get(settings["avion"], cache_path))
+
+    assert age == 0
+    [location] = locations
+    assert location["passphrase"] == "secret"
+    assert [device["mac_address"] for device in location["devices"]] == ["aa:bb:cc:dd:ee:01", "aa:bb:cc:dd:ee:02"]
+    assert location["groups"][0]["devices"] == ["d1", "d2"]
+    assert inventory_load(cache_path)[0] == locations
+
+    # the next start comes from the cache, without asking the cloud
+    requests = api.requests
+    cached, age = asyncio.run(inventory_get(settings["avion"], cache_path))
+    assert cached == locations
+    assert age < INVENTORY_TTL
+    assert api.requests == requests
+
+
+def test_stale_cache_is_refreshed_in_the_background(api, tmp_path):
+    settings = settings_for(api)
+    cache_path = str(tmp_path / "inventory.json")
+    [fresh], _ = asyncio.run(inventory_get(settings["avion"], str(tmp_path / "fresh.json")))
+    stale = copy.deepcopy(fresh)
+    stale["passphrase"] = "old secret"
+    cache_write(cache_path, [stale], 2 * INVENTORY_TTL)
+
+    # the bridge starts from the stale cache right away
+    [location], age = asyncio.run(inventory_get(settings["avion"], cache_path))
+    assert location == stale
+    assert age > INVENTORY_TTL
+
+    async def refresh():
+        site = site_for(location, settings)
+        discovery = DiscoveryPublisher(Recorder())
+        await inventory_refresh(settings, [site], discovery, cache_path)
+        return site
+
+    site = asyncio.run(refresh())
+    assert site.location == fresh
+    assert site.key == mesh_key("secret")
+    # the running mesh pipeline is told to restart with the new key
+    assert site.reload.is_set()
+    cached, age = inventory_load(cache_path)
+    assert cached == [fresh]
+    assert age < INVENTORY_TTL
+
+
+def test_unchanged_inventory_leaves_the_pipeline_running(api, tmp_path):
+    settings = settings_for(api)
+    cache_path = str(tmp_path / "inventory.json")
+    [location], _ = asyncio.run(inventory_get(settings["avion"], cache_path))
+
+    async def refresh():
+        site = site_for(copy.deepcopy(location), settings)
+        await inventory_refresh(settings, [site], DiscoveryPublisher(Recorder()), cache_path)
+        return site
+
+    assert not asyncio.run(refresh()).reload.is_set()
+
+
+def test_refresh_publishes_discovery_differences(api, tmp_path):
+    settings = settings_for(api)
+    cache_path = str(tmp_path / "inventory.json")
+    [location], _ = asyncio.run(inventory_get(settings["avion"], cache_path))
+    # Hall goes away, Desk is renamed and Porch is added
+    api.inventory["devices"] = [
+        {**DEVICES[0], "name": "Study"},
+        {"pid": "d3", "product_id": 134, "avid": 32899, "name": "Porch", "friendly_mac_address": "AABBCCDDEE03"},
+    ]
+    api.inventory["groups"] = [{**GROUPS[0], "devices": ["d1", "d3"]}]
+
+    async def refresh():
+        mqtt = Recorder()
+        discovery = DiscoveryPublisher(mqtt)
+        task = asyncio.create_task(discovery.run())
+        site = site_for(location, settings)
+        discovery.publish(site.discovery)
+        await asyncio.sleep(0.01)
+        mqtt.published.clear()
+
+        await inventory_refresh(settings, [site], discovery, cache_path)
+        await asyncio.sleep(0.01)
+        task.cancel()
+        return mqtt.published
+
+    published = asyncio.run(refresh())
+    assert json.loads(published["homeassistant/light/study/config"])["name"] == "Study"
+    assert json.loads(published["homeassistant/light/porch/config"])["name"] == "Porch"
+    assert published[f"{MQTT_TOPIC_PREFIX}/32899/availability"] == "online"
+    # what went away is cleared
+    assert published["homeassistant/light/desk/config"] == ""
+    assert published["homeassistant/light/hall/config"] == ""
+    assert published[f"{MQTT_TOPIC_PREFIX}/32898/availability"] == ""
+    # and what didn't change isn't published again
+    assert "homeassistant/light/office/config" not in published
+    assert f"{MQTT_TOPIC_PREFIX}/1/availability" not in published
+
+
+def test_refresh_matches_locations_by_pid(api, tmp_path):
+    settings = settings_for(api)
+    cache_path = str(tmp_path / "inventory.json")
+    [location], _ = asyncio.run(inventory_get(settings["avion"], cache_path))
+    gone = {**copy.deepcopy(location), "pid": 2, "name": "Cabin", "passphrase": "cabin"}
+    api.inventory["passphrase"] = "new secret"
+
+    async def refresh():
+        # a location the cloud no longer lists comes first
+        sites = [site_for(gone, settings), site_for(copy.deepcopy(location), settings)]
+        await inventory_refresh(settings, sites, DiscoveryPublisher(Recorder()), cache_path)
+        return sites
+
+    cabin, home = asyncio.run(refresh())
+    assert cabin.location == gone
+    assert not cabin.reload.is_set()
+    assert home.location["passphrase"] == "new secret"
+    assert home.reload.is_set()
+
+
+def test_requests_waiting_for_a_connection_dont_time_out(api):
+    # more groups than fit through the connection pool in one timeout
+    api.inventory["groups"] = [
+        {"pid": f"g{i}", "avid": i, "name": f"Group {i}", "devices": ["d1"]} for i in range(1, 5 * HTTP_CONCURRENCY)
+    ]
+    api.delay = 0.1
+    host = settings_for(api)["avion"]["host"]
+
+    [location] = asyncio.run(http_list_devices("user@example.com", "password", host, timeout=0.5))
+
+    assert len(location["groups"]) == len(api.inventory["groups"])
+    # and none of them had to be asked for again
+    assert api.requests == 1 + 1 + 3 + len(api.inventory["groups"])
@@ -0,0 +1,91 @@
+import asyncio
+import logging
+
+from avionmqtt import mesh_key
+from avionmqtt.mesh import MESH_THROUGHPUT_SAMPLE, MeshPool, MeshWriter
+from avionmqtt.notifications import NotificationPipeline
+
+KEY = mesh_key("secret")
+PACKET = bytes(range(10))
+
+
+class Characteristic:
+    properties = ["write", "write-without-response"]
+
+
+class Services:
+    def get_characteristic(self, uuid):
+        return Characteristic()
+
+
+class Client:
+    """Stands in for a connected mesh node, taking `delay` seconds for every write."""
+
+    def __init__(self, delay: float = 0):
+        self.services = Services()
+        self.delay = delay
+        self.is_connected = True
+
+    async def write_gatt_char(self, uuid, data: bytes, response: bool):
+        await asyncio.sleep(self.delay)
+
+    async def disconnect(self):
+        await asyncio.sleep(0.01)
+        self.is_connected = False
+
+
+async def write(writer: MeshWriter, count: int):
+    for _ in range(count):
+        await writer.write(PACKET)
+    await writer.flush()
+
+
+def test_throughput_leaves_out_idle_time(caplog):
+    async def run():
+        writer = MeshWriter(KEY, {"write_rate": 1000})
+        writer.add("aa:bb:cc:dd:ee:01", Client(0.002))
+        half = MESH_THROUGHPUT_SAMPLE // 2
+        await write(writer, half)
+        # nothing to write for a while doesn't make the mesh any slower
+        await asyncio.sleep(1)
+        await write(writer, MESH_THROUGHPUT_SAMPLE - half)
+        await write(writer, MESH_THROUGHPUT_SAMPLE)
+        writer.close()
+        return writer.throughput
+
+    with caplog.at_level(logging.INFO, logger="avionmqtt.mesh"):
+        throughput = asyncio.run(run())
+    # each packet takes two writes of 2 ms, counting the second of idle time would bring it down to about 50
+    assert 100 < throughput < 260
+    assert len([record for record in caplog.records if "commands/sec" in record.message]) == 1
+
+
+def test_throughput_measured_earlier_is_kept(caplog):
+    async def run():
+        writer = MeshWriter(KEY, {"write_rate": 1000}, throughput=5.0)
+        writer.add("aa:bb:cc:dd:ee:01", Client(0))
+        await write(writer, MESH_THROUGHPUT_SAMPLE)
+        writer.close()
+        return writer.throughput
+
+    with caplog.at_level(logging.INFO, logger="avionmqtt.mesh"):
+        assert asyncio.run(run()) == 5.0
+    assert not [record for record in caplog.records if "commands/sec" in record.message]
+
+
+def test_lost_node_is_disconnected():
+    async def run():
+        writer = MeshWriter(KEY)
+        pool = MeshPool(None, writer, NotificationPipeline(lambda data: None, lambda *args: None), lambda: [])
+        client = Client()
+        pool._clients["aa:bb:cc:dd:ee:01"] = client
+        writer.add("aa:bb:cc:dd:ee:01", client)
+        pool.lost("aa:bb:cc:dd:ee:01")
+        assert len(pool) == 0 and len(writer) == 0
+        # the disconnect carries on in the background, held on to by the pool until it is done
+        [task] = pool._disconnecting
+        await task
+        assert not pool._disconnecting
+        return client
+
+    assert not asyncio.run(run()).is_connected
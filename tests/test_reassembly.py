@@ -0,0 +1,165 @@
+import pytest
+
+from avionmqtt import reassembly
+from avionmqtt.reassembly import LOW_SIZE, MeshReassembler
+
+LOW = bytes(range(LOW_SIZE))
+HIGH = bytes(range(100, 108))
+PACKET = LOW + HIGH
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(reassembly, "time", clock)
+    return clock
+
+
+def other(packet: bytes) -> bytes:
+    """A packet with another sequence number."""
+    return bytes([packet[0] + 1]) + packet[1:]
+
+
+def test_low_then_high(clock):
+    reassembler = MeshReassembler()
+    assert reassembler.feed_low(LOW) is None
+    assert reassembler.feed_high(HIGH) == PACKET
+
+
+def test_high_then_low(clock):
+    reassembler = MeshReassembler()
+    assert reassembler.feed_high(HIGH) is None
+    assert reassembler.feed_low(LOW) == PACKET
+
+
+def test_short_packet_needs_no_high_half(clock):
+    reassembler = MeshReassembler()
+    assert reassembler.feed_low(LOW[:16]) == LOW[:16]
+
+
+def test_halves_are_only_paired_within_a_link(clock):
+    reassembler = MeshReassembler()
+    assert reassembler.feed_low(LOW, "a") is None
+    assert reassembler.feed_high(HIGH, "b") is None
+    assert reassembler.feed_high(HIGH, "a") == PACKET
+    assert reassembler.feed_low(LOW, "b") == PACKET
+
+
+@pytest.mark.parametrize("first_low", [True, False])
+def test_orphan_times_out(clock, first_low):
+    reassembler = MeshReassembler(fragment_timeout=1.0)
+    if first_low:
+        assert reassembler.feed_low(LOW) is None
+        clock.now += 1.5
+        assert reassembler.feed_high(HIGH) is None
+    else:
+        assert reassembler.feed_high(HIGH) is None
+        clock.now += 1.5
+        assert reassembler.feed_low(LOW) is None
+    assert reassembler.orphaned == 1
+    # the stale half is gone, while the newer one waits for its match
+    assert (reassembler.feed_low(LOW) if first_low else reassembler.feed_high(HIGH)) == PACKET
+
+
+def test_half_replaced_by_a_newer_one_is_orphaned(clock):
+    reassembler = MeshReassembler()
+    assert reassembler.feed_low(other(LOW)) is None
+    assert reassembler.feed_low(LOW) is None
+    assert reassembler.orphaned == 1
+    assert reassembler.feed_high(HIGH) == PACKET
+
+
+def test_forgetting_a_link_orphans_its_half(clock):
+    reassembler = MeshReassembler()
+    reassembler.feed_low(LOW, "a")
+    reassembler.forget("a")
+    reassembler.forget("b")
+    assert reassembler.orphaned == 1
+    assert reassembler.feed_high(HIGH, "a") is None
+
+
+def test_duplicates_are_dropped_across_links(clock):
+    reassembler = MeshReassembler()
+    reassembler.feed_low(LOW, "a")
+    packet = reassembler.feed_high(HIGH, "a")
+    reassembler.accept(packet)
+    # the same packet relayed by another node, or flooded again
+    reassembler.feed_low(LOW, "b")
+    assert reassembler.feed_high(HIGH, "b") is None
+    assert reassembler.feed_high(HIGH, "a") is None
+    assert reassembler.feed_low(LOW, "a") is None
+    assert reassembler.duplicates == 2
+    assert reassembler.packets == 1
+
+
+def test_rejected_packets_arent_remembered(clock):
+    reassembler = MeshReassembler()
+    reassembler.feed_low(LOW)
+    packet = reassembler.feed_high(HIGH)
+    reassembler.reject(packet)
+    assert reassembler.dropped == 1
+    reassembler.feed_low(LOW)
+    assert reassembler.feed_high(HIGH) == PACKET
+
+
+def test_duplicate_window_is_bounded(clock):
+    reassembler = MeshReassembler(dedup_window=1)
+    reassembler.accept(PACKET)
+    reassembler.accept(other(PACKET))
+    # only the most recent sequence number is remembered
+    reassembler.feed_low(LOW)
+    assert reassembler.feed_high(HIGH) == PACKET
+    reassembler.feed_low(other(LOW))
+    assert reassembler.feed_high(HIGH) is None
+
+
+def half(n: int, low: bool) -> bytes:
+    """The LOW or HIGH half of the `n`th packet of a burst."""
+    return bytes([n]) * LOW_SIZE if low else bytes([100 + n]) * 8
+
+
+def authentic(packet: bytes) -> bool:
+    return packet[LOW_SIZE] == packet[0] + 100
+
+
+def feed(reassembler: MeshReassembler, halves) -> list:
+    """Feeds halves the way the notification pipeline does, returning the packets that authenticated."""
+    accepted = []
+    for data, low in halves:
+        packet = reassembler.feed_low(data, "a") if low else reassembler.feed_high(data, "a")
+        if packet is None:
+            continue
+        if authentic(packet):
+            reassembler.accept(packet, "a")
+            accepted.append(packet[0])
+        else:
+            reassembler.reject(packet, "a")
+    return accepted
+
+
+def test_lost_low_half_doesnt_break_the_packets_after_it(clock):
+    reassembler = MeshReassembler()
+    # the LOW half of packet 1 got lost, then a burst follows
+    halves = [(half(1, False), False)]
+    for n in range(2, 6):
+        halves += [(half(n, True), True), (half(n, False), False)]
+    assert feed(reassembler, halves) == [2, 3, 4, 5]
+    assert reassembler.orphaned == 1
+    assert reassembler.dropped == 0
+
+
+def test_high_half_first_still_pairs_in_a_burst(clock):
+    reassembler = MeshReassembler()
+    halves = []
+    for n in range(1, 5):
+        halves += [(half(n, False), False), (half(n, True), True)]
+    assert feed(reassembler, halves) == [1, 2, 3, 4]
+    assert reassembler.orphaned == 0
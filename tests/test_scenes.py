@@ -0,0 +1,115 @@
+import asyncio
+import json
+
+import pytest
+
+from avionmqtt import Site, scene_submit
+from avionmqtt.commands import CommandScheduler
+from avionmqtt.scenes import scene_parse, scene_plan, scene_switch_on
+
+ALL = frozenset({10, 11, 12, 13})
+GROUPS = {0: ALL, 1: frozenset({10, 11}), 2: frozenset({12, 13}), 3: frozenset({11, 12}), 4: frozenset({13})}
+
+
+def test_uniform_scene_is_one_packet_per_field():
+    lights = {avid: {"brightness": 100, "color_temp": 300} for avid in ALL}
+    assert scene_plan(lights, GROUPS, lit=set(ALL)) == [
+        (0, "brightness", 100, (10, 11, 12, 13)),
+        (0, "color_temp", 300, (10, 11, 12, 13)),
+    ]
+
+
+def test_largest_uniform_groups_are_picked_first():
+    lights = {10: {"brightness": 50}, 11: {"brightness": 50}, 12: {"brightness": 50}, 13: {"brightness": 80}}
+    plan = scene_plan(lights, GROUPS, lit=set(ALL))
+    # {10, 11} and {11, 12} are both uniform, but a light is only ever covered once
+    assert plan == [(1, "brightness", 50, (10, 11)), (12, "brightness", 50, ()), (13, "brightness", 80, ())]
+
+
+def test_groups_need_every_member_in_the_scene():
+    lights = {10: {"brightness": 50}, 12: {"brightness": 50}, 13: {"brightness": 50}}
+    plan = scene_plan(lights, GROUPS, lit=set())
+    assert plan == [(2, "brightness", 50, (12, 13)), (10, "brightness", 50, ())]
+
+
+def test_single_member_groups_are_never_used():
+    plan = scene_plan({13: {"brightness": 5}}, GROUPS, lit=set())
+    assert plan == [(13, "brightness", 5, ())]
+
+
+def test_hidden_color_changes_go_first():
+    lights = {
+        10: {"brightness": 0, "color_temp": 250},
+        11: {"brightness": 0, "color_temp": 250},
+        12: {"brightness": 90, "color_temp": 400},
+        13: {"brightness": 60, "color_temp": 370},
+    }
+    # 10 and 11 are off, so their color can change before anything visible does
+    plan = scene_plan(lights, GROUPS, lit={12, 13})
+    assert plan == [
+        (1, "color_temp", 250, (10, 11)),
+        (1, "brightness", 0, (10, 11)),
+        (12, "brightness", 90, ()),
+        (13, "brightness", 60, ()),
+        (12, "color_temp", 400, ()),
+        (13, "color_temp", 370, ()),
+    ]
+
+
+def test_scene_parse():
+    message = {
+        "scene": "Evening",
+        "location": 7,
+        "lights": [
+            {"avid": "10", "state": "ON"},
+            {"avid": 11, "state": "OFF", "color_temp": 300},
+            # a scene that turns a light on means it, color or not
+            {"avid": 12, "state": "ON", "color_temp": 300},
+            {"avid": 13, "brightness": 500},
+            # later entries for the same light are merged in
+            {"avid": 10, "color_temp": 250},
+        ],
+    }
+    name, location, lights = scene_parse(json.dumps(message))
+    assert (name, location) == ("Evening", "7")
+    assert lights == {
+        10: {"state": "ON", "color_temp": 250},
+        11: {"brightness": 0, "color_temp": 300},
+        12: {"state": "ON", "color_temp": 300},
+        13: {"brightness": 255},
+    }
+
+
+def test_scene_switch_on():
+    lights = {10: {"state": "ON", "color_temp": 300}, 11: {"state": "ON"}, 12: {"brightness": 0}}
+    scene_switch_on(lights, {10: 40, 12: 80})
+    # back on at the brightness it had, or at full when that isn't known
+    assert lights == {10: {"brightness": 40, "color_temp": 300}, 11: {"brightness": 255}, 12: {"brightness": 0}}
+
+
+@pytest.mark.parametrize(
+    "raw_payload",
+    ["{}", '{"lights": [{"brightness": 10}]}', '{"lights": [{"avid": 10, "color_temp": 0}]}', '{"lights": 3}'],
+)
+def test_scene_parse_rejects_malformed_messages(raw_payload):
+    with pytest.raises(ValueError):
+        scene_parse(raw_payload)
+
+
+@pytest.mark.parametrize("location", [1, "1", "Home"])
+def test_scene_submit_finds_the_location_by_id_or_name(location):
+    settings = {"groups": {"import": True}, "devices": {"import": True}}
+
+    async def run():
+        sites = []
+        for pid, name in ((1, "Home"), (2, "Cabin")):
+            site = Site(
+                {"pid": pid, "name": name, "passphrase": name, "devices": [], "groups": []}, name, None, settings
+            )
+            site.commands = CommandScheduler(None)
+            site.scene = lambda *args: None
+            sites.append(site)
+        scene_submit(json.dumps({"scene": "Evening", "location": location, "lights": []}), sites)
+        return [len(site.commands) for site in sites]
+
+    assert asyncio.run(run()) == [1, 0]